@@ -0,0 +1,293 @@
+import asyncio
+import time
+
+import httpx
+from datasets import Image, load_from_disk
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http import models
+from tqdm import tqdm
+
+from ai_search_demo.qdrant_inexing import (
+    COLPALI_BASE_URL,
+    COLPALI_TOKEN,
+    EMBED_BATCH_SIZE,
+    EMBED_MAX_RETRIES,
+    EMBEDDING_WIRE_FORMAT,
+    MULTIVECTOR_NAME,
+    POOL_FACTOR,
+    QDRANT_GRPC_PORT,
+    QDRANT_POOL_SIZE,
+    QDRANT_PORT,
+    QDRANT_PREFER_GRPC,
+    QDRANT_URI,
+    UPSERT_BATCH_SIZE,
+    UPSERT_MAX_RETRIES,
+    UPSERT_RETRY_BACKOFF,
+    UPLOAD_MAX_PIXELS,
+    collection_config,
+    decode_embedding_response,
+    embedding_headers,
+    has_named_vectors,
+    image_upload_bytes,
+    legacy_collection_error,
+    page_vectors,
+    row_page_text,
+    row_payload,
+    row_point_ids,
+)
+
+# Constants
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = 120.0
+ENCODE_CONCURRENCY = 4
+EMBED_CONCURRENCY = 8
+UPSERT_CONCURRENCY = 2
+STAGE_QUEUE_SIZE = 16
+
+
+class AsyncColPaliClient:
+    def __init__(
+        self,
+        base_url: str = COLPALI_BASE_URL,
+        token: str = COLPALI_TOKEN,
+        max_connections: int = HTTP_POOL_SIZE,
+        wire_format: str = EMBEDDING_WIRE_FORMAT,
+    ):
+        # One pooled client, connections are kept alive between requests
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {token}", **embedding_headers(wire_format)},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=HTTP_TIMEOUT,
+        )
+
+    async def query_text(self, query_text: str):
+        response = await self.client.post("/query", params={"query_text": query_text})
+        response.raise_for_status()
+        return decode_embedding_response(response)
+
+    async def process_image_bytes(self, image_bytes: bytes):
+        response = await self.client.post("/process_image", files={"image": image_bytes})
+        response.raise_for_status()
+        return decode_embedding_response(response)
+
+    async def process_images_bytes(self, images_bytes):
+        files = [("images", (f"image_{i}.jpg", image_bytes, "image/jpeg")) for i, image_bytes in enumerate(images_bytes)]
+        response = await self.client.post("/process_images", files=files)
+        response.raise_for_status()
+        return decode_embedding_response(response)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class AsyncIngestClient:
+    """
+    Ingest as three overlapping stages joined by bounded queues:
+    encode (dataset rows -> JPEG bytes), embed (ColPali) and upsert (Qdrant).
+    Each stage has its own number of workers, a full queue blocks the stage
+    before it, so at most a few chunks of pages are in memory at once.
+    """
+
+    def __init__(self, qdrant_uri: str = QDRANT_URI, prefer_grpc: bool = QDRANT_PREFER_GRPC):
+        self.qdrant_client = AsyncQdrantClient(
+            qdrant_uri,
+            port=QDRANT_PORT,
+            grpc_port=QDRANT_GRPC_PORT,
+            prefer_grpc=prefer_grpc,
+            https=True,
+            # same bounded pool as create_vector_client, passed on to the httpx client of the REST transport
+            limits=httpx.Limits(max_connections=QDRANT_POOL_SIZE, max_keepalive_connections=QDRANT_POOL_SIZE),
+        )
+        self.colpali_client = AsyncColPaliClient()
+
+    async def create_collection(self, collection_name):
+        await self.qdrant_client.create_collection(collection_name=collection_name, **collection_config())
+
+    async def embed_images(self, images_bytes, max_retries: int = EMBED_MAX_RETRIES):
+        # Retries cover network blips and ColPali cold starts, same as IngestClient.embed_images
+        for attempt in range(max_retries + 1):
+            try:
+                return (await self.colpali_client.process_images_bytes(images_bytes))['embeddings']
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                print(f"Error during embedding (attempt {attempt + 1}/{max_retries + 1}): {e}")
+                await asyncio.sleep(UPSERT_RETRY_BACKOFF * 2**attempt)
+
+    async def ingest(
+        self,
+        collection_name,
+        dataset,
+        embed_batch_size: int = EMBED_BATCH_SIZE,
+        upsert_batch_size: int = UPSERT_BATCH_SIZE,
+        encode_concurrency: int = ENCODE_CONCURRENCY,
+        embed_concurrency: int = EMBED_CONCURRENCY,
+        upsert_concurrency: int = UPSERT_CONCURRENCY,
+        queue_size: int = STAGE_QUEUE_SIZE,
+        max_retries: int = UPSERT_MAX_RETRIES,
+        pool_factor: int = POOL_FACTOR,
+        max_pixels: int = UPLOAD_MAX_PIXELS,
+        skip_existing: bool = True,
+        exclude_point_ids=(),
+    ):
+        if not await self.qdrant_client.collection_exists(collection_name):
+            await self.create_collection(collection_name)
+        elif not has_named_vectors(await self.qdrant_client.get_collection(collection_name)):
+            raise legacy_collection_error(collection_name)
+
+        encode_queue = asyncio.Queue(maxsize=queue_size)
+        embed_queue = asyncio.Queue(maxsize=queue_size)
+        upsert_queue = asyncio.Queue(maxsize=queue_size)
+        exclude_point_ids = set(exclude_point_ids)
+        metadata = dataset.remove_columns(["image"])
+        images_column = dataset.select_columns(["image"]).cast_column("image", Image(decode=False))
+        uploaded = 0
+        skipped = 0
+        failed_ids = []
+        tokens_before, tokens_after = 0, 0
+
+        async def produce():
+            for start in range(0, len(dataset), embed_batch_size):
+                await encode_queue.put(start)
+
+        async def encode(start):
+            nonlocal skipped
+            rows = metadata[start:start + embed_batch_size]
+            point_ids = row_point_ids(rows, start)
+            # exclude_point_ids are rows of replaced PDF versions (see update_pdfs_hf_dataset)
+            offsets = [offset for offset in range(len(point_ids)) if point_ids[offset] not in exclude_point_ids]
+            if skip_existing and offsets:
+                existing = await self.qdrant_client.retrieve(
+                    collection_name, ids=[point_ids[offset] for offset in offsets], with_payload=False, with_vectors=False
+                )
+                existing = {point.id for point in existing}
+                offsets = [offset for offset in offsets if point_ids[offset] not in existing]
+            skipped += len(point_ids) - len(offsets)
+            pbar.update(len(point_ids) - len(offsets))
+            if not offsets:
+                return
+
+            def read_and_encode():
+                images = images_column[[start + offset for offset in offsets]]["image"]
+                return [image_upload_bytes(image, max_pixels) for image in images]
+
+            # Row reads and any resizing are CPU bound, keep them off the event loop
+            images_bytes = await asyncio.to_thread(read_and_encode)
+            await embed_queue.put((rows, point_ids, offsets, images_bytes))
+
+        async def embed(item):
+            nonlocal tokens_before, tokens_after
+            rows, point_ids, offsets, images_bytes = item
+            try:
+                image_embeddings = await self.embed_images(images_bytes)
+            except Exception as e:
+                # Only this batch fails, the other stages and in-flight batches keep going
+                print(f"Error during embedding of {len(offsets)} pages, giving up: {e}")
+                failed_ids.extend(point_ids[offset] for offset in offsets)
+                pbar.update(len(offsets))
+                return
+            # Token pooling is CPU bound as well
+            all_vectors = await asyncio.to_thread(
+                lambda: [
+                    page_vectors(image_embedding, pool_factor, row_page_text(rows, offset))
+                    for offset, image_embedding in zip(offsets, image_embeddings)
+                ]
+            )
+            for offset, image_embedding, vectors in zip(offsets, image_embeddings, all_vectors):
+                tokens_before += len(image_embedding)
+                tokens_after += len(vectors[MULTIVECTOR_NAME])
+                point = models.PointStruct(
+                    id=point_ids[offset],  # stable id from PDF content + page
+                    vector=vectors,
+                    payload=row_payload(rows, offset),
+                )
+                await upsert_queue.put(point)
+
+        async def upsert(points):
+            nonlocal uploaded
+            for attempt in range(max_retries + 1):
+                try:
+                    await self.qdrant_client.upsert(collection_name=collection_name, points=points, wait=True)
+                    break
+                except Exception as e:
+                    if attempt == max_retries:
+                        print(f"Error during upsert of {len(points)} points, giving up: {e}")
+                        failed_ids.extend(point.id for point in points)
+                        return
+                    print(f"Error during upsert (attempt {attempt + 1}/{max_retries + 1}): {e}")
+                    await asyncio.sleep(UPSERT_RETRY_BACKOFF * 2**attempt)
+            uploaded += len(points)
+            pbar.update(len(points))
+
+        async def worker(queue, handle):
+            while (item := await queue.get()) is not None:
+                await handle(item)
+
+        async def upsert_worker():
+            points = []
+            while (point := await upsert_queue.get()) is not None:
+                points.append(point)
+                if len(points) >= upsert_batch_size:
+                    await upsert(points)
+                    points = []
+            if points:
+                await upsert(points)
+
+        async def stage(workers, next_queue, next_workers):
+            # When all workers of a stage are done, stop the workers of the next one
+            await asyncio.gather(*workers)
+            for _ in range(next_workers):
+                await next_queue.put(None)
+
+        start_time = time.perf_counter()
+        with tqdm(total=len(dataset), desc="Indexing Progress", unit="page") as pbar:
+            # TaskGroup cancels every stage if one of them fails, so nothing waits on a dead queue
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(stage([produce()], encode_queue, encode_concurrency))
+                tg.create_task(stage([worker(encode_queue, encode) for _ in range(encode_concurrency)], embed_queue, embed_concurrency))
+                tg.create_task(stage([worker(embed_queue, embed) for _ in range(embed_concurrency)], upsert_queue, upsert_concurrency))
+                tg.create_task(stage([upsert_worker() for _ in range(upsert_concurrency)], upsert_queue, 0))
+
+        elapsed = time.perf_counter() - start_time
+        stats = {
+            "pages": uploaded,
+            "skipped": skipped,
+            "failed": len(failed_ids),
+            "failed_ids": failed_ids,
+            "dead_letters": len(failed_ids),  # no journal, only this run's failures
+            "seconds": elapsed,
+            "pages_per_sec": uploaded / elapsed if elapsed > 0 else 0.0,
+            "pool_factor": pool_factor,
+            "compression_ratio": tokens_before / tokens_after if tokens_after else 1.0,
+        }
+        if failed_ids:
+            print(f"Failed to ingest {len(failed_ids)} pages: {failed_ids}")
+        print(f"Indexing complete! {stats['pages']} pages in {elapsed:.1f}s ({stats['pages_per_sec']:.2f} pages/sec), {skipped} already indexed")
+        print(f"Multivector compression: {tokens_before} -> {tokens_after} vectors ({stats['compression_ratio']:.2f}x)")
+        return stats
+
+    async def aclose(self):
+        await self.colpali_client.aclose()
+        await self.qdrant_client.close()
+
+
+async def ingest_async(collection_name: str, dataset_path: str, pool_factor: int = POOL_FACTOR) -> dict:
+    ingest_client = AsyncIngestClient()
+    try:
+        return await ingest_client.ingest(collection_name, load_from_disk(dataset_path), pool_factor=pool_factor)
+    finally:
+        await ingest_client.aclose()
+
+
+def ingest(collection_name: str, dataset_path: str, pool_factor: int = POOL_FACTOR) -> None:
+    # Ingest a saved HF dataset (e.g. storage/<collection>/hf_dataset) with the asyncio pipeline
+    asyncio.run(ingest_async(collection_name, dataset_path, pool_factor))
+
+
+if __name__ == '__main__':
+    import typer
+
+    app = typer.Typer()
+    app.command()(ingest)
+    app()
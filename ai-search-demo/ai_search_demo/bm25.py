@@ -0,0 +1,68 @@
+import re
+import unicodedata
+import zlib
+from collections import Counter
+
+from qdrant_client.http import models
+
+# Constants
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_AVG_DOC_LENGTH = 256  # tokens, fixed so page vectors don't depend on the rest of the collection
+RRF_K = 2  # same constant as Qdrant's RRF, score = sum of 1 / (RRF_K + rank) with 0-based ranks
+# Latin words and numbers (part numbers like "AB-1234" stay one token), or runs of Japanese/Chinese/Korean characters
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+(?:[-_./][0-9a-z]+)*|[぀-ヿ㐀-鿿가-힯]+")
+
+
+def tokenize(text: str) -> list:
+    """
+    Lowercased NFKC tokens: Latin words and numbers, plus the parts of compound
+    tokens such as part numbers, and character bigrams for CJK text, which has no
+    spaces between words.
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text or "").lower()):
+        token = match.group()
+        if token[0].isascii():
+            tokens.append(token)
+            parts = re.split(r"[-_./]", token)
+            if len(parts) > 1:
+                tokens.extend(parts)
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def token_index(token: str) -> int:
+    # Stable across processes (unlike hash()), Qdrant sparse indices are uint32
+    return zlib.crc32(token.encode("utf-8"))
+
+
+def sparse_vector(weights: dict) -> models.SparseVector:
+    indices = sorted(weights)
+    return models.SparseVector(indices=indices, values=[weights[index] for index in indices])
+
+
+def bm25_document_vector(text: str) -> models.SparseVector:
+    """
+    BM25 term weights of a page, without IDF: the collection's sparse vector uses
+    Qdrant's IDF modifier, so document frequencies are applied at query time.
+    """
+    counts = Counter(token_index(token) for token in tokenize(text))
+    length_norm = 1 - BM25_B + BM25_B * sum(counts.values()) / BM25_AVG_DOC_LENGTH
+    return sparse_vector({index: tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm) for index, tf in counts.items()})
+
+
+def bm25_query_vector(text: str) -> models.SparseVector:
+    return sparse_vector(dict.fromkeys({token_index(token) for token in tokenize(text)}, 1.0))
+
+
+def rrf_fuse(rankings, limit: int, k: int = RRF_K) -> list:
+    """Reciprocal-rank fusion of ranked id lists, returns [(id, score)] best first."""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, point_id in enumerate(ranking):
+            scores[point_id] += 1 / (k + rank)
+    return scores.most_common(limit)
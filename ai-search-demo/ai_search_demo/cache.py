@@ -0,0 +1,228 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Constants
+QUERY_CACHE_MAX_SIZE = 10_000
+QUERY_CACHE_TTL_SECONDS = 24 * 60 * 60
+QUERY_CACHE_PATH = None  # e.g. "storage/query_cache.sqlite" to share embeddings between processes
+QUERY_CACHE_DISK_MAX_SIZE = 100_000
+ANSWER_CACHE_MAX_SIZE = 1_000
+ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+ANSWER_CACHE_PATH = None  # e.g. "answer_cache.sqlite" to share VLM answers between processes and restarts
+ANSWER_CACHE_DISK_MAX_SIZE = 10_000
+DISK_CACHE_PRUNE_EVERY = 100  # writes between deletes of expired and oldest rows, the row cap may be exceeded by this much
+
+
+class LRUCache:
+    """In-process LRU cache with a max number of entries and an optional TTL."""
+
+    def __init__(self, max_size: int, ttl_seconds: float = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            if self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds:
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.data[key] = (value, time.time())
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SQLiteCache:
+    """
+    On-disk key/value store for JSON-serializable values, safe to share between processes.
+    Expired rows are deleted when read and, with the oldest rows beyond `max_size`,
+    on open and every DISK_CACHE_PRUNE_EVERY writes.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = None, table: str = "cache", max_size: int = None):
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)")
+        self.connection.commit()
+        self.prune()
+
+    def expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.expired(row[1]):
+                self.connection.execute(f"DELETE FROM {self.table} WHERE key = ? AND created_at = ?", (key, row[1]))
+                self.connection.commit()
+                return None
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key, value):
+        with self.lock:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+            self.connection.commit()
+            self.writes += 1
+        if self.writes % DISK_CACHE_PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        with self.lock:
+            if self.ttl_seconds is not None:
+                self.connection.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            if self.max_size is not None:
+                # Oldest first, like the in-process LRU (reads don't refresh rows on disk)
+                self.connection.execute(
+                    f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+def normalize_query(query_text: str) -> str:
+    # Unicode (full/half-width) and whitespace differences don't change what the user asked for
+    return " ".join(unicodedata.normalize("NFKC", query_text).split())
+
+
+class TieredCache:
+    """In-process LRU backed by an optional SQLite file, with hit/miss counters."""
+
+    def __init__(self, max_size: int, ttl_seconds: float, disk_path: str = None, table: str = "cache", disk_max_size: int = None):
+        self.memory = LRUCache(max_size, ttl_seconds)
+        self.disk = SQLiteCache(disk_path, ttl_seconds, table=table, max_size=disk_max_size) if disk_path else None
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            with self.lock:
+                self.memory_hits += 1
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+                with self.lock:
+                    self.disk_hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            # ndarrays (binary wire format embeddings) are stored as JSON lists
+            self.disk.set(key, value.tolist() if hasattr(value, "tolist") else value)
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "size": len(self.memory),
+        }
+
+
+class QueryEmbeddingCache(TieredCache):
+    """
+    Two-tier cache for query embeddings. Keys are model name + normalized query,
+    so switching the embedding model never serves stale vectors.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_size: int = QUERY_CACHE_MAX_SIZE,
+        ttl_seconds: float = QUERY_CACHE_TTL_SECONDS,
+        disk_path: str = QUERY_CACHE_PATH,
+        disk_max_size: int = QUERY_CACHE_DISK_MAX_SIZE,
+    ):
+        super().__init__(max_size, ttl_seconds, disk_path, table="query_embeddings", disk_max_size=disk_max_size)
+        self.model_name = model_name
+
+    def key(self, query_text: str) -> str:
+        return f"{self.model_name}\n{normalize_query(query_text)}"
+
+    def get(self, query_text: str):
+        return super().get(self.key(query_text))
+
+    def set(self, query_text: str, embedding):
+        super().set(self.key(query_text), embedding)
+
+    def get_or_compute(self, query_text: str, compute):
+        embedding = self.get(query_text)
+        if embedding is None:
+            embedding = compute(query_text)
+            self.set(query_text, embedding)
+        return embedding
+
+
+class AnswerCache(TieredCache):
+    """
+    Two-tier cache for VLM answers. Keys hash the model, the prompt template version,
+    the content of the images exactly as sent (after resizing and encoding) and the
+    normalized user query, so a popular page asked about again costs no GPU time.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        prompt_version: str,
+        max_size: int = ANSWER_CACHE_MAX_SIZE,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        disk_path: str = ANSWER_CACHE_PATH,
+        disk_max_size: int = ANSWER_CACHE_DISK_MAX_SIZE,
+    ):
+        super().__init__(max_size, ttl_seconds, disk_path, table="vlm_answers", disk_max_size=disk_max_size)
+        self.model_name = model_name
+        self.prompt_version = prompt_version
+
+    def key(self, images, query_text: str = "") -> str:
+        # images are the encoded images (bytes or data URL strings) in prompt order
+        sha256 = hashlib.sha256(f"{self.model_name}\n{self.prompt_version}\n{normalize_query(query_text)}".encode())
+        for image in images:
+            sha256.update(hashlib.sha256(image.encode() if isinstance(image, str) else image).digest())
+        return sha256.hexdigest()
@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Constants
+CATALOG_PATH = "storage/catalog.sqlite"  # next to the collections, in the storage volume
+COLLECTION_INFO_FILENAME = "collection_info.json"  # per-directory metadata used before the catalog, imported once
+CATALOG_COLUMNS = {
+    "name": "TEXT PRIMARY KEY",
+    "status": "TEXT NOT NULL",
+    "files": "TEXT NOT NULL",  # JSON list of PDF file names
+    "number_of_PDFs": "INTEGER NOT NULL",
+    "pages": "INTEGER",
+    "vectors": "INTEGER",
+    "failed_pages": "INTEGER",
+    "pool_factor": "INTEGER",
+    "compression_ratio": "REAL",
+    "ingest_seconds": "REAL",
+    "pages_per_sec": "REAL",
+    "embedding_model": "TEXT",
+    "created_at": "REAL NOT NULL",
+    "updated_at": "REAL NOT NULL",
+}
+
+
+class CollectionCatalog:
+    """
+    One SQLite (WAL) table with a row per collection, shared by the UI, the ingest
+    workers and the evaluation harness. Status changes update single columns, and
+    listing is one indexed query instead of a directory scan plus a JSON file per collection.
+    """
+
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS collections ({', '.join(f'{name} {kind}' for name, kind in CATALOG_COLUMNS.items())})"
+        )
+        self.connection.commit()
+
+    def row_to_dict(self, row) -> dict:
+        collection = dict(row)
+        collection["files"] = json.loads(collection["files"])
+        return collection
+
+    def get(self, name: str):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM collections WHERE name = ?", (name,)).fetchone()
+        return self.row_to_dict(row) if row is not None else None
+
+    def list(self) -> list:
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM collections ORDER BY name").fetchall()
+        return [self.row_to_dict(row) for row in rows]
+
+    def names(self) -> list:
+        with self.lock:
+            return [name for name, in self.connection.execute("SELECT name FROM collections ORDER BY name").fetchall()]
+
+    def update(self, name: str, **fields):
+        """Creates the collection if needed and sets only the given columns."""
+        with self.lock:
+            self._upsert(name, fields)
+            self.connection.commit()
+
+    def _upsert(self, name: str, fields: dict):
+        # callers hold self.lock and commit
+        unknown = set(fields) - set(CATALOG_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown catalog columns: {sorted(unknown)}")
+        if "files" in fields:
+            fields["number_of_PDFs"] = len(fields["files"])
+            fields["files"] = json.dumps(fields["files"])
+        now = time.time()
+        fields["updated_at"] = now
+        values = {"status": "new", "files": "[]", "number_of_PDFs": 0, "created_at": now, **fields}
+        self.connection.execute(
+            f"""
+            INSERT INTO collections (name, {', '.join(values)}) VALUES (?, {', '.join('?' for _ in values)})
+            ON CONFLICT(name) DO UPDATE SET {', '.join(f'{key} = excluded.{key}' for key in fields)}
+            """,
+            (name, *values.values()),
+        )
+
+    def add_files(self, name: str, file_names, **fields):
+        # Read-modify-write of the file list in one write transaction, concurrent uploads don't lose files
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT files FROM collections WHERE name = ?", (name,)).fetchone()
+                files = json.loads(row["files"]) if row is not None else []
+                files += [file_name for file_name in file_names if file_name not in files]
+                self._upsert(name, {**fields, "files": files})
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+    def import_collection_dirs(self, storage_dir: str) -> int:
+        """Adds collections that only have a collection_info.json (created before the catalog), returns how many."""
+        if not os.path.exists(storage_dir):
+            return 0
+        known = set(self.names())
+        imported = 0
+        for name in os.listdir(storage_dir):
+            info_path = os.path.join(storage_dir, name, COLLECTION_INFO_FILENAME)
+            if name in known or not os.path.exists(info_path):
+                continue
+            with open(info_path, "r") as json_file:
+                collection_info = json.load(json_file)
+            fields = {key: value for key, value in collection_info.items() if key in CATALOG_COLUMNS and key != "name"}
+            self.update(name, **fields)
+            imported += 1
+        return imported
+
+    def close(self):
+        self.connection.close()
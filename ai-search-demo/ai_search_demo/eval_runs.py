@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+import pandas as pd
+
+# Constants
+RUNS_DIR = "eval_runs"
+
+
+def run_id(collection_name: str, query_text_key: str, embedding_model: str, index_config: dict) -> str:
+    """Readable, stable run key: the same collection, queries, model and index config map to the same files."""
+    config_hash = hashlib.sha1(json.dumps(index_config, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+    parts = [collection_name, query_text_key, embedding_model, index_config.get("search_mode", ""), config_hash]
+    return "__".join(re.sub(r"[^0-9A-Za-z._-]+", "-", str(part)) for part in parts)
+
+
+def run_paths(run_dir: Path, name: str) -> dict:
+    return {
+        # One row per retrieved (query, doc) with rank and score, plus relevant docs that were not retrieved
+        "table": run_dir / f"{name}.parquet",
+        "meta": run_dir / f"{name}.json",
+    }
+
+
+def write_atomic(path: Path, write):
+    # Written next to the target and renamed, readers never see half a file
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_run(relevant_docs: dict, results: dict, meta: dict, runs_dir: str = RUNS_DIR) -> str:
+    """
+    Writes one evaluation run (TREC-style run + qrels in a single Parquet table) and
+    a JSON file with its key fields, so metrics can be recomputed without embedding
+    or searching again. Returns the run id, runs with the same key are replaced.
+    """
+    run_dir = Path(runs_dir)
+    run_dir.mkdir(parents=True, exist_ok=True)
+    name = run_id(meta["collection_name"], meta["query_text_key"], meta["embedding_model"], meta["index_config"])
+    paths = run_paths(run_dir, name)
+
+    rows = []
+    for query_id, relevant in relevant_docs.items():
+        ranked = sorted(results.get(query_id, {}).items(), key=lambda item: item[1], reverse=True)
+        for rank, (doc_id, score) in enumerate(ranked, start=1):
+            rows.append((query_id, doc_id, rank, score, relevant.get(doc_id, 0)))
+        retrieved = {doc_id for doc_id, _ in ranked}
+        rows.extend((query_id, doc_id, None, None, relevance) for doc_id, relevance in relevant.items() if doc_id not in retrieved)
+    table = pd.DataFrame(rows, columns=["query_id", "doc_id", "rank", "score", "relevance"]).astype(
+        {"rank": "Int32", "score": "float64", "relevance": "int8"}
+    )
+
+    write_atomic(paths["table"], lambda tmp_path: table.to_parquet(tmp_path, index=False))
+    meta = {"run_id": name, "created_at": time.time(), **meta}
+    write_atomic(paths["meta"], lambda tmp_path: tmp_path.write_text(json.dumps(meta, indent=2)))
+    return name
+
+
+def resolve_run(run: str, runs_dir: str = RUNS_DIR) -> dict:
+    # A run id, or the path of its .parquet / .json file
+    path = Path(run)
+    if path.suffix in (".parquet", ".json") and path.exists():
+        return run_paths(path.parent, path.stem)
+    paths = run_paths(Path(runs_dir), run)
+    if not paths["meta"].exists():
+        raise ValueError(f"Run '{run}' not found in {runs_dir}")
+    return paths
+
+
+def load_run(run: str, runs_dir: str = RUNS_DIR):
+    """Returns (meta, relevant_docs, results) in the dict shapes used by run_evaluation."""
+    paths = resolve_run(run, runs_dir)
+    meta = json.loads(paths["meta"].read_text())
+    table = pd.read_parquet(paths["table"])
+    relevant_docs, results = {}, {}
+    for query_id, doc_id, rank, score, relevance in table.itertuples(index=False):
+        results.setdefault(query_id, {})
+        if relevance > 0:
+            relevant_docs.setdefault(query_id, {})[doc_id] = int(relevance)
+        if not pd.isna(rank):
+            results[query_id][doc_id] = float(score)
+    return meta, relevant_docs, results
+
+
+def list_runs(runs_dir: str = RUNS_DIR) -> list:
+    run_dir = Path(runs_dir)
+    if not run_dir.exists():
+        return []
+    metas = [json.loads(path.read_text()) for path in run_dir.glob("*.json")]
+    return sorted(metas, key=lambda meta: meta["created_at"], reverse=True)
+
+
+def first_relevant_ranks(relevant_docs: dict, results: dict) -> dict:
+    """Rank (1-based) of the first relevant document per query, None when it was not retrieved."""
+    ranks = {}
+    for query_id, relevant in relevant_docs.items():
+        ranked = sorted(results.get(query_id, {}).items(), key=lambda item: item[1], reverse=True)
+        ranks[query_id] = next((rank for rank, (doc_id, _) in enumerate(ranked, start=1) if relevant.get(doc_id, 0) > 0), None)
+    return ranks
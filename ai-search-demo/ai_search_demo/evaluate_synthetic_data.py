@@ -1,6 +1,8 @@
 import base64
 import os
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from typing import Dict, List
 
@@ -14,11 +16,27 @@ from rich import print
 from rich.table import Table
 from tqdm import tqdm
 
-from ai_search_demo.qdrant_inexing import SearchClient, pdfs_to_hf_dataset, IngestClient
+from ai_search_demo.catalog import CollectionCatalog
+from ai_search_demo.eval_runs import RUNS_DIR, first_relevant_ranks, list_runs, load_run, save_run
+from ai_search_demo.qdrant_inexing import (
+    COLPALI_MODEL_NAME,
+    POOL_FACTOR,
+    PREFETCH_LIMIT,
+    SEARCH_MAX_IN_FLIGHT,
+    SEARCH_MODE,
+    SearchClient,
+    pdfs_to_hf_dataset,
+    IngestClient,
+)
 
 # Initialize OpenAI client
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
+# Constants
+QUERY_TEXT_KEYS = ["question_en", "question_jp"]
+EVAL_TOP_K = 10
+DIFF_SHOW_QUERIES = 10  # queries with the largest rank changes listed by `diff`
+
 class DataSample(BaseModel):
     japanese_query: str
     english_query: str
@@ -85,7 +103,8 @@ def create_synthetic_dataset(input_folder: str, output_folder: str, hub_repo: st
             "question_en": sample.english_query,
             "question_jp": sample.japanese_query,
             "pdf_name": pdf_name,
-            "pdf_page": pdf_page
+            "pdf_page": pdf_page,
+            "page_text": data_point['page_text'],  # indexed for hybrid search
         })
 
     # Create a new dataset from synthetic data
@@ -95,45 +114,143 @@ def create_synthetic_dataset(input_folder: str, output_folder: str, hub_repo: st
     # Save the dataset card
     synthetic_dataset.push_to_hub(hub_repo, private=False)
 
-def evaluate_on_synthetic_dataset(hub_repo: str, collection_name: str = "synthetic-dataset-evaluate-full") -> None:
+def evaluate_on_synthetic_dataset(
+    hub_repo: str,
+    collection_name: str = "synthetic-dataset-evaluate-full",
+    search_mode: str = SEARCH_MODE,
+    ingest: bool = False,
+    pool_factor: int = POOL_FACTOR,
+) -> None:
     # Ingest collection with IngestClient
     print("Load data")
     synthetic_dataset = load_dataset(hub_repo)['train']
 
-    print("Ingest data to qdrant")
-    # ingest_client = IngestClient()
-    # ingest_client.ingest(collection_name, synthetic_dataset)
+    catalog = CollectionCatalog()
+    collection_info = None
+    if ingest:
+        # Ingest into a fresh collection, e.g. once per pool factor to compare recall with compression
+        ingest_client = IngestClient()
+        if ingest_client.qdrant_client.collection_exists(collection_name):
+            # Its pages would all be skipped, keeping the vectors (and pool factor) of the earlier ingest
+            raise ValueError(f"Collection '{collection_name}' already exists, pick a new name to ingest with pool_factor={pool_factor}")
+        print("Ingest data to qdrant")
+        catalog.update(collection_name, status="processing")
+        stats = ingest_client.ingest(collection_name, synthetic_dataset, pool_factor=pool_factor)
+        catalog.update(
+            collection_name,
+            status="done" if stats['failed'] == 0 else "done_with_failures",
+            pages=len(synthetic_dataset),
+            vectors=ingest_client.qdrant_client.get_collection(collection_name).points_count,
+            failed_pages=stats['failed'],
+        )
+        if stats['pages'] > 0:
+            # Only pages embedded by this run have the requested compression
+            catalog.update(
+                collection_name,
+                pool_factor=stats['pool_factor'],
+                compression_ratio=round(stats['compression_ratio'], 2),
+                ingest_seconds=round(stats['seconds'], 1),
+                pages_per_sec=round(stats['pages_per_sec'], 2),
+                embedding_model=COLPALI_MODEL_NAME,
+            )
+        collection_info = catalog.get(collection_name)
+    else:
+        # Scores are only comparable when the collection was embedded with the current model
+        collection_info = catalog.get(collection_name)
+        if collection_info is None:
+            print(f"[yellow]{collection_name} is not in the catalog, ingest details unknown[/yellow]")
+        elif collection_info["embedding_model"] not in (None, COLPALI_MODEL_NAME):
+            print(f"[yellow]{collection_name} was embedded with {collection_info['embedding_model']}, queries use {COLPALI_MODEL_NAME}[/yellow]")
 
-    run_evaluation(synthetic_dataset=synthetic_dataset, collection_name=collection_name, query_text_key='question_en')
-    run_evaluation(synthetic_dataset=synthetic_dataset, collection_name=collection_name, query_text_key='question_jp')
+    # Part of the run key, so runs of differently compressed collections are kept apart
+    index_config = {"pool_factor": collection_info["pool_factor"] if collection_info else None}
 
-def run_evaluation(synthetic_dataset: Dataset, collection_name: str, query_text_key: str) -> None:
+    # Both language passes share one SearchClient (connection pools, query cache) and run concurrently
     search_client = SearchClient()
+    with ThreadPoolExecutor(max_workers=len(QUERY_TEXT_KEYS)) as executor:
+        list(executor.map(
+            lambda query_text_key: run_evaluation(
+                synthetic_dataset=synthetic_dataset,
+                collection_name=collection_name,
+                query_text_key=query_text_key,
+                search_mode=search_mode,
+                search_client=search_client,
+                index_config=index_config,
+                dataset_name=hub_repo,
+            ),
+            QUERY_TEXT_KEYS,
+        ))
+
+def run_evaluation(
+    synthetic_dataset: Dataset,
+    collection_name: str,
+    query_text_key: str,
+    search_mode: str = SEARCH_MODE,
+    search_client: SearchClient = None,
+    max_in_flight: int = SEARCH_MAX_IN_FLIGHT,
+    index_config: dict = None,
+    dataset_name: str = None,
+    runs_dir: str = RUNS_DIR,
+) -> dict:
+    search_client = search_client or SearchClient()
     relevant_docs: Dict[str, Dict[str, int]] = {}
     results: Dict[str, Dict[str, float]] = {}
 
-    for x in synthetic_dataset:
-        query_id = f"{x['pdf_name']}_{x['pdf_page']}"
+    # Queries are embedded in batches and searched with query_batch_points, not one round trip per query
+    start_time = time.perf_counter()
+    rows = synthetic_dataset.select_columns(["pdf_name", "pdf_page", query_text_key])[:]
+    responses = search_client.search_images_by_texts(
+        rows[query_text_key], collection_name=collection_name, top_k=EVAL_TOP_K, mode=search_mode, max_in_flight=max_in_flight
+    )
+    elapsed = time.perf_counter() - start_time
+
+    for pdf_name, pdf_page, response in zip(rows["pdf_name"], rows["pdf_page"], responses):
+        query_id = f"{pdf_name}_{pdf_page}"
         relevant_docs[query_id] = {query_id: 1}  # The most relevant document is itself
 
-        response = search_client.search_images_by_text(query_text=x[query_text_key], collection_name=collection_name, top_k=10)
-        
         results[query_id] = {}
         for point in response.points:
             doc_id = f"{point.payload['pdf_name']}_{point.payload['pdf_page']}"
             results[query_id][doc_id] = point.score
 
+    # The run file has everything needed to recompute metrics, see `replay` and `diff`
+    name = save_run(
+        relevant_docs,
+        results,
+        {
+            "collection_name": collection_name,
+            "query_text_key": query_text_key,
+            "embedding_model": COLPALI_MODEL_NAME,
+            "index_config": {"search_mode": search_mode, "prefetch_limit": PREFETCH_LIMIT, "top_k": EVAL_TOP_K, **(index_config or {})},
+            "dataset": dataset_name,
+            "queries": len(responses),
+            "seconds": elapsed,
+        },
+        runs_dir,
+    )
+
+    scores = compute_scores(relevant_docs, results)
+    table = scores_table(
+        scores,
+        title=f"Evaluation Scores for {query_text_key} ({search_mode})",
+        caption=f"{len(responses)} queries in {elapsed:.1f}s ({len(responses) / max(elapsed, 1e-9):.0f} queries/sec), run {name}",
+    )
+    print(table)
+    return scores
+
+def compute_scores(relevant_docs: Dict[str, Dict[str, int]], results: Dict[str, Dict[str, float]], k_values: List[int] = None) -> dict:
     mteb_evaluator = CustomRetrievalEvaluator()
+    k_values = k_values or mteb_evaluator.k_values
 
     ndcg, _map, recall, precision, naucs = mteb_evaluator.evaluate(
         relevant_docs,
         results,
-        mteb_evaluator.k_values,
+        k_values,
     )
 
-    mrr = mteb_evaluator.evaluate_custom(relevant_docs, results, mteb_evaluator.k_values, "mrr")
+    mrr = mteb_evaluator.evaluate_custom(relevant_docs, results, k_values, "mrr")
 
-    scores = {
+    return {
         **{f"ndcg_at_{k.split('@')[1]}": v for (k, v) in ndcg.items()},
         **{f"map_at_{k.split('@')[1]}": v for (k, v) in _map.items()},
         **{f"recall_at_{k.split('@')[1]}": v for (k, v) in recall.items()},
@@ -142,14 +259,69 @@ def run_evaluation(synthetic_dataset: Dataset, collection_name: str, query_text_
         **{f"naucs_at_{k.split('@')[1]}": v for (k, v) in naucs.items()},
     }
 
+def scores_table(scores: dict, title: str, caption: str = None) -> Table:
     # Use rich to print scores beautifully
-    table = Table(title=f"Evaluation Scores for {query_text_key}")
+    table = Table(title=title, caption=caption)
     table.add_column("Metric", justify="right", style="cyan", no_wrap=True)
     table.add_column("Score", style="magenta")
 
     for metric, score in scores.items():
         table.add_row(metric, f"{score:.4f}")
+    return table
+
+def replay(run: str, runs_dir: str = RUNS_DIR, k_values: List[int] = None) -> None:
+    # Metrics from a stored run, no embedding or search; k values above the run's top_k see no extra hits
+    meta, relevant_docs, results = load_run(run, runs_dir)
+    scores = compute_scores(relevant_docs, results, k_values)
+    print(scores_table(scores, title=f"Evaluation Scores for {meta['query_text_key']} ({meta['index_config']['search_mode']})", caption=f"run {meta['run_id']}"))
+
+def diff(run_a: str, run_b: str, runs_dir: str = RUNS_DIR, k_values: List[int] = None) -> None:
+    meta_a, relevant_a, results_a = load_run(run_a, runs_dir)
+    meta_b, relevant_b, results_b = load_run(run_b, runs_dir)
+    if relevant_a != relevant_b:
+        print("[yellow]The runs have different queries or relevance judgments, metrics are not directly comparable[/yellow]")
+    scores_a = compute_scores(relevant_a, results_a, k_values)
+    scores_b = compute_scores(relevant_b, results_b, k_values)
+
+    table = Table(title="Evaluation diff", caption=f"A: {meta_a['run_id']}\nB: {meta_b['run_id']}")
+    table.add_column("Metric", justify="right", style="cyan", no_wrap=True)
+    table.add_column("A", style="magenta")
+    table.add_column("B", style="magenta")
+    table.add_column("B - A")
+    for metric in scores_a:
+        delta = scores_b.get(metric, 0.0) - scores_a[metric]
+        color = "green" if delta > 0 else "red" if delta < 0 else "white"
+        table.add_row(metric, f"{scores_a[metric]:.4f}", f"{scores_b.get(metric, 0.0):.4f}", f"[{color}]{delta:+.4f}[/{color}]")
+    print(table)
+
+    # Per query: where the first relevant page moved, unretrieved counts as rank top_k + 1
+    ranks_a = first_relevant_ranks(relevant_a, results_a)
+    ranks_b = first_relevant_ranks(relevant_b, results_b)
+    missing_rank = max(meta_a["index_config"]["top_k"], meta_b["index_config"]["top_k"]) + 1
+    changes = [
+        (query_id, ranks_a[query_id], ranks_b[query_id])
+        for query_id in ranks_a.keys() & ranks_b.keys()
+        if ranks_a[query_id] != ranks_b[query_id]
+    ]
+    changes.sort(key=lambda change: abs((change[2] or missing_rank) - (change[1] or missing_rank)), reverse=True)
+    better = sum((rank_b or missing_rank) < (rank_a or missing_rank) for _, rank_a, rank_b in changes)
+
+    table = Table(title="Queries with changed first relevant rank", caption=f"{better} better, {len(changes) - better} worse in B")
+    table.add_column("Query")
+    table.add_column("Rank A", justify="right")
+    table.add_column("Rank B", justify="right")
+    for query_id, rank_a, rank_b in changes[:DIFF_SHOW_QUERIES]:
+        table.add_row(query_id, str(rank_a or "-"), str(rank_b or "-"))
+    print(table)
 
+def runs(runs_dir: str = RUNS_DIR) -> None:
+    # Newest first, the run id already has collection, query field, model and search mode in it
+    table = Table(title=f"Evaluation runs in {runs_dir}")
+    table.add_column("run_id", no_wrap=True)
+    for column in ("dataset", "queries"):
+        table.add_column(column)
+    for meta in list_runs(runs_dir):
+        table.add_row(meta["run_id"], str(meta["dataset"]), str(meta["queries"]))
     print(table)
 
 
@@ -157,4 +329,7 @@ if __name__ == '__main__':
     app = typer.Typer()
     app.command()(create_synthetic_dataset)
     app.command()(evaluate_on_synthetic_dataset)
+    app.command()(replay)
+    app.command()(diff)
+    app.command()(runs)
     app()
\ No newline at end of file
@@ -0,0 +1,204 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from datasets import load_from_disk
+from rich import print
+from rich.table import Table
+
+from ai_search_demo.qdrant_inexing import VECTOR_BACKEND, IngestClient
+
+# Constants
+JOURNAL_FILENAME = "ingest_journal.sqlite"
+
+
+class IngestJournal:
+    """
+    Local SQLite progress journal for one ingest job. A page is recorded as `done`
+    once Qdrant acknowledged its upsert, or `failed` (dead letter) when embedding or
+    upserting still failed after retries. The job's collection, dataset path and
+    ingest parameters are stored too, so `resume_ingest_job` needs only the journal.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                point_id TEXT PRIMARY KEY,
+                row_index INTEGER,
+                pdf_name TEXT,
+                pdf_page INTEGER,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def set_job(self, **values):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO job (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in values.items()],
+            )
+            self.connection.commit()
+
+    def job(self) -> dict:
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM job").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def _record(self, points, status: str, error: str = None):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pages (point_id, row_index, pdf_name, pdf_page, status, error, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (str(point.id), point.payload.get("index"), point.payload.get("pdf_name"), point.payload.get("pdf_page"), status, error, now)
+                    for point in points
+                ],
+            )
+            self.connection.commit()
+
+    def mark_done(self, points):
+        self._record(points, "done")
+
+    def mark_failed(self, points, error):
+        self._record(points, "failed", str(error))
+
+    def _point_ids(self, statuses) -> set:
+        # Point ids as used in Qdrant: uuid strings or positional ints
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT point_id FROM pages WHERE status IN ({', '.join('?' * len(statuses))})", statuses
+            ).fetchall()
+        return {int(point_id) if point_id.isdigit() else point_id for point_id, in rows}
+
+    def finished_point_ids(self) -> set:
+        return self._point_ids(("done", "failed"))
+
+    def failed_point_ids(self) -> set:
+        return self._point_ids(("failed",))
+
+    def delete_points(self, point_ids):
+        # Pages deleted from the collection (replaced PDF versions) are forgotten, they are ingested again if they come back
+        with self.lock:
+            self.connection.executemany("DELETE FROM pages WHERE point_id = ?", [(str(point_id),) for point_id in point_ids])
+            self.connection.commit()
+
+    def dead_letters(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT point_id, row_index, pdf_name, pdf_page, error FROM pages WHERE status = 'failed' ORDER BY row_index"
+            ).fetchall()
+
+    def reset_failed(self):
+        # Put dead-lettered pages back in the queue for the next run
+        with self.lock:
+            self.connection.execute("DELETE FROM pages WHERE status = 'failed'")
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def counts(self) -> dict:
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM pages GROUP BY status").fetchall())
+
+
+def default_journal_path(dataset_path: str) -> str:
+    # Next to the HF dataset, i.e. in the collection directory
+    return os.path.join(os.path.dirname(os.path.abspath(dataset_path)), JOURNAL_FILENAME)
+
+
+def run_ingest_job(
+    collection_name: str,
+    dataset_path: str,
+    journal_path: str = None,
+    backend: str = VECTOR_BACKEND,
+    retry_failed: bool = False,
+    ingest_client: IngestClient = None,
+    on_progress=None,
+    **ingest_kwargs,
+) -> dict:
+    # ingest_client and on_progress are for long-lived callers (the UI, ingest_worker.py), they are not journaled
+    journal = IngestJournal(journal_path or default_journal_path(dataset_path))
+    try:
+        if retry_failed:
+            journal.reset_failed()
+        journal.set_job(
+            collection_name=collection_name,
+            dataset_path=dataset_path,
+            backend=backend,
+            ingest_kwargs=ingest_kwargs,
+            status="running",
+        )
+        dataset = load_from_disk(dataset_path)
+        try:
+            ingest_client = ingest_client or IngestClient(backend=backend)
+            stats = ingest_client.ingest(collection_name, dataset, journal=journal, on_progress=on_progress, **ingest_kwargs)
+        except BaseException:
+            journal.set_job(status="interrupted")
+            raise
+        # Dead letters of earlier runs count too, until they are retried with retry_failed
+        journal.set_job(status="done" if stats["dead_letters"] == 0 else "done_with_failures")
+        print(f"Journal {journal.path}: {journal.counts()}")
+        return stats
+    finally:
+        journal.close()
+
+
+def resume_ingest_job(journal_path: str, retry_failed: bool = False) -> dict:
+    # Continue from the last checkpoint, pages already acknowledged by Qdrant are not embedded again
+    journal = IngestJournal(journal_path)
+    job = journal.job()
+    journal.close()
+    if not job:
+        raise ValueError(f"No ingest job found in {journal_path}")
+    return run_ingest_job(
+        job["collection_name"],
+        job["dataset_path"],
+        journal_path=journal_path,
+        backend=job["backend"],
+        retry_failed=retry_failed,
+        **job["ingest_kwargs"],
+    )
+
+
+def ingest(collection_name: str, dataset_path: str, journal_path: str = None, backend: str = VECTOR_BACKEND) -> None:
+    run_ingest_job(collection_name, dataset_path, journal_path=journal_path, backend=backend)
+
+
+def resume(journal_path: str, retry_failed: bool = False) -> None:
+    resume_ingest_job(journal_path, retry_failed=retry_failed)
+
+
+def dead_letters(journal_path: str) -> None:
+    journal = IngestJournal(journal_path)
+    rows = journal.dead_letters()
+    journal.close()
+    table = Table(title=f"Dead letters in {journal_path}")
+    for column in ("point_id", "row_index", "pdf_name", "pdf_page", "error"):
+        table.add_column(column)
+    for row in rows:
+        table.add_row(*[str(value) for value in row])
+    print(table)
+
+
+if __name__ == '__main__':
+    # typer is only needed for the CLI, the UI imports this module too
+    import typer
+
+    app = typer.Typer()
+    app.command()(ingest)
+    app.command()(resume)
+    app.command()(dead_letters)
+    app()
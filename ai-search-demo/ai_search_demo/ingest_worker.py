@@ -0,0 +1,391 @@
+import functools
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+
+from datasets import load_from_disk
+from rich import print
+from rich.table import Table
+
+from ai_search_demo.catalog import CATALOG_PATH, CollectionCatalog
+from ai_search_demo.ingest_job import IngestJournal, default_journal_path, run_ingest_job
+from ai_search_demo.qdrant_inexing import (
+    COLPALI_MODEL_NAME,
+    RENDER_WORKERS,
+    IngestClient,
+    has_named_vectors,
+    update_pdfs_hf_dataset,
+    write_thumbnails,
+)
+
+# Constants
+JOBS_DB_PATH = "storage/ingest_jobs.sqlite"
+INGEST_WORKERS = 1  # collections processed in parallel, each one renders with up to RENDER_WORKERS processes
+JOB_POLL_SECONDS = 1.0
+JOB_STALE_SECONDS = 10 * 60  # running jobs without a heartbeat for this long are requeued (worker died)
+JOB_HEARTBEAT_SECONDS = 30
+PROGRESS_FLUSH_SECONDS = 0.5
+PROGRESS_STAGES = ("rendered", "skipped", "embedded", "upserted", "failed")
+HF_DATASET_DIRNAME = "hf_dataset"
+THUMBNAILS_DIRNAME = "thumbnails"
+RENDER_CACHE_DIRNAME = "render_cache"  # Arrow files of newly rendered pages, removed once the dataset is saved
+
+
+class JobQueue:
+    """
+    Ingest jobs in a local SQLite table, shared by the UI that enqueues them and the
+    workers that run them, also across processes. A job goes queued -> running ->
+    done/done_with_failures/error, `progress` holds the page count per stage (see PROGRESS_STAGES).
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                collection_name TEXT NOT NULL,
+                collection_dir TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                updated_at REAL NOT NULL,
+                finished_at REAL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def enqueue(self, collection_name: str, collection_dir: str) -> int:
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (collection_name, collection_dir, status, progress, created_at, updated_at) VALUES (?, ?, 'queued', '{}', ?, ?)",
+                (collection_name, collection_dir, now, now),
+            )
+            self.connection.commit()
+        return cursor.lastrowid
+
+    def claim(self):
+        """Marks the oldest runnable job as running and returns it, None when there is nothing to do."""
+        now = time.time()
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock first, so two workers never claim the same job
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'queued', stage = NULL WHERE status = 'running' AND updated_at < ?",
+                    (now - JOB_STALE_SECONDS,),
+                )
+                # One job at a time per collection, appends to the same dataset must not overlap
+                row = self.connection.execute(
+                    """
+                    SELECT * FROM jobs WHERE status = 'queued'
+                    AND collection_name NOT IN (SELECT collection_name FROM jobs WHERE status = 'running')
+                    ORDER BY id LIMIT 1
+                    """
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET status = 'running', started_at = ?, updated_at = ? WHERE id = ?", (now, now, row["id"])
+                    )
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return dict(row) if row is not None else None
+
+    def update(self, job_id: int, **fields):
+        if "progress" in fields:
+            fields["progress"] = json.dumps(fields["progress"])
+        fields["updated_at"] = time.time()
+        with self.lock:
+            self.connection.execute(
+                f"UPDATE jobs SET {', '.join(f'{key} = ?' for key in fields)} WHERE id = ?", (*fields.values(), job_id)
+            )
+            self.connection.commit()
+
+    def heartbeat(self, job_id: int):
+        # Only while the job is still ours, a requeued job is not marked alive again
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+            self.connection.commit()
+
+    def finish(self, job_id: int, status: str, error: str = None):
+        self.update(job_id, status=status, error=error, finished_at=time.time())
+
+    def jobs(self, limit: int = 50) -> list:
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [{**dict(row), "progress": json.loads(row["progress"])} for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+class JobProgress:
+    """
+    Page counters of one running job, usable as `on_progress(stage, pages)` callback.
+    Counts are written to the job table at most every PROGRESS_FLUSH_SECONDS.
+    """
+
+    def __init__(self, jobs: JobQueue, job_id: int):
+        self.jobs = jobs
+        self.job_id = job_id
+        self.stage = None
+        self.counts = dict.fromkeys(PROGRESS_STAGES, 0)
+        self.lock = threading.Lock()
+        self.flushed_at = 0.0
+
+    def __getstate__(self):
+        # datasets hashes on_page into the dataset fingerprint, the job table connection can't be pickled
+        return {"job_id": self.job_id, "counts": self.counts}
+
+    def __call__(self, stage: str, pages: int = 1):
+        with self.lock:
+            self.counts[stage] += pages
+        if time.time() - self.flushed_at >= PROGRESS_FLUSH_SECONDS:
+            self.flush()
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts = dict(self.counts)
+            self.flushed_at = time.time()
+        self.jobs.update(self.job_id, stage=self.stage, progress=counts)
+
+
+class JobHeartbeat(threading.Thread):
+    """
+    Marks a claimed job alive every JOB_HEARTBEAT_SECONDS until the `with` block exits,
+    so a stage that reports no progress for long (a huge PDF, a slow embedding batch)
+    doesn't get the job requeued as stale while its worker is still running it.
+    """
+
+    def __init__(self, jobs: JobQueue, job_id: int, interval: float = JOB_HEARTBEAT_SECONDS):
+        super().__init__(daemon=True)
+        self.jobs = jobs
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.jobs.heartbeat(self.job_id)
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.join()
+
+
+def migrate_legacy_collection(collection_name: str, collection_dir: str, existing_dataset, ingest_client: IngestClient) -> bool:
+    """
+    Collections created before page ids (no `pdf_sha256` column) or named vectors can't
+    be appended to: the dataset is rebuilt in a new row order and Qdrant rejects points
+    with named vectors. Drops the Qdrant collection, journal rows and thumbnails so the
+    caller re-renders and re-ingests every page, returns whether it did.
+    """
+    qdrant_client = ingest_client.qdrant_client
+    collection_exists = qdrant_client.collection_exists(collection_name)
+    legacy_dataset = existing_dataset is not None and "pdf_sha256" not in existing_dataset.column_names
+    if not legacy_dataset and not (collection_exists and not has_named_vectors(qdrant_client.get_collection(collection_name))):
+        return False
+    print(f"[yellow]Migrating {collection_name}: created before page ids / named vectors, re-ingesting every page[/yellow]")
+    if collection_exists:
+        qdrant_client.delete_collection(collection_name)
+    journal_path = default_journal_path(os.path.join(collection_dir, HF_DATASET_DIRNAME))
+    if os.path.exists(journal_path):
+        journal = IngestJournal(journal_path)
+        journal.delete_points(journal.finished_point_ids())
+        journal.close()
+    # Legacy thumbnails are named by row index, which changes with the rebuilt dataset
+    shutil.rmtree(os.path.join(collection_dir, THUMBNAILS_DIRNAME), ignore_errors=True)
+    return True
+
+
+def process_collection(
+    collection_name: str,
+    collection_dir: str,
+    progress: JobProgress,
+    catalog: CollectionCatalog,
+    ingest_client: IngestClient = None,
+) -> dict:
+    """Renders new or changed PDFs of a collection directory to its HF dataset and ingests them."""
+    catalog.update(collection_name, status="processing")
+    status = "error"
+    try:
+        # Transform new or changed PDFs to HF dataset rows, appended to the existing dataset
+        progress.set_stage("rendering")
+        dataset_path = os.path.join(collection_dir, HF_DATASET_DIRNAME)
+        existing_dataset = load_from_disk(dataset_path) if os.path.exists(dataset_path) else None
+        ingest_client = ingest_client or IngestClient()
+        if migrate_legacy_collection(collection_name, collection_dir, existing_dataset, ingest_client):
+            existing_dataset = None
+        render_cache_dir = os.path.join(collection_dir, RENDER_CACHE_DIRNAME)
+        try:
+            dataset, stale_point_ids = update_pdfs_hf_dataset(
+                collection_dir,
+                existing_dataset,
+                num_workers=RENDER_WORKERS,
+                on_page=functools.partial(progress, "rendered"),
+                cache_dir=render_cache_dir,
+            )
+            # datasets can't overwrite the directory it reads from, so write next to it and swap
+            tmp_dataset_path = dataset_path + ".tmp"
+            shutil.rmtree(tmp_dataset_path, ignore_errors=True)
+            dataset.save_to_disk(tmp_dataset_path)
+            shutil.rmtree(dataset_path, ignore_errors=True)
+            os.rename(tmp_dataset_path, dataset_path)
+        finally:
+            # The saved dataset is the only copy of the rendered pages
+            shutil.rmtree(render_cache_dir, ignore_errors=True)
+        dataset = load_from_disk(dataset_path)
+        # Thumbnails for the search results, only new pages are rendered
+        progress.set_stage("thumbnails")
+        write_thumbnails(dataset, os.path.join(collection_dir, THUMBNAILS_DIRNAME))
+
+        # Ingest collection with IngestClient, pages already in Qdrant are skipped.
+        # Progress is journaled in the collection dir, see ingest_job.py to resume a failed job
+        progress.set_stage("embedding")
+        ingest_client.delete_points(collection_name, stale_point_ids)
+        journal = IngestJournal(default_journal_path(dataset_path))
+        journal.delete_points(stale_point_ids)
+        journal.close()
+        stats = run_ingest_job(
+            collection_name,
+            dataset_path,
+            retry_failed=True,
+            ingest_client=ingest_client,
+            on_progress=progress,
+            exclude_point_ids=stale_point_ids,
+        )
+        catalog.update(
+            collection_name,
+            # Stale rows stay in the dataset, the payload `index` of every point is its row number
+            pages=len(dataset) - len(stale_point_ids),
+            vectors=ingest_client.qdrant_client.get_collection(collection_name).points_count,
+            failed_pages=stats['dead_letters'],
+        )
+        if stats['pages'] > 0:
+            # A run that only skipped pages says nothing about how the collection was embedded
+            catalog.update(
+                collection_name,
+                pool_factor=stats['pool_factor'],
+                compression_ratio=round(stats['compression_ratio'], 2),
+                ingest_seconds=round(stats['seconds'], 1),
+                pages_per_sec=round(stats['pages_per_sec'], 2),
+                embedding_model=COLPALI_MODEL_NAME,
+            )
+        status = "done" if stats["dead_letters"] == 0 else "done_with_failures"
+        return stats
+    finally:
+        progress.set_stage(status)
+        catalog.update(collection_name, status=status)
+
+
+class IngestWorkerPool:
+    """
+    Background threads that claim jobs from the job table and run process_collection,
+    so uploads return at once and survive browser reloads. Jobs left running by a
+    dead process are picked up again once stale, ingest skips pages already indexed.
+    """
+
+    def __init__(
+        self,
+        jobs_path: str = JOBS_DB_PATH,
+        num_workers: int = INGEST_WORKERS,
+        poll_seconds: float = JOB_POLL_SECONDS,
+        catalog_path: str = CATALOG_PATH,
+    ):
+        self.jobs = JobQueue(jobs_path)
+        self.catalog = CollectionCatalog(catalog_path)
+        self.num_workers = num_workers
+        self.poll_seconds = poll_seconds
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self.work, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def work(self):
+        ingest_client = IngestClient()
+        while not self.stopped.is_set():
+            job = self.jobs.claim()
+            if job is None:
+                self.stopped.wait(self.poll_seconds)
+                continue
+            self.run_job(job, ingest_client)
+
+    def run_job(self, job: dict, ingest_client: IngestClient):
+        progress = JobProgress(self.jobs, job["id"])
+        try:
+            with JobHeartbeat(self.jobs, job["id"]):
+                stats = process_collection(job["collection_name"], job["collection_dir"], progress, self.catalog, ingest_client)
+        except Exception as e:
+            traceback.print_exc()
+            self.jobs.finish(job["id"], "error", str(e))
+            return
+        self.jobs.finish(job["id"], "done" if stats["dead_letters"] == 0 else "done_with_failures")
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def run(num_workers: int = INGEST_WORKERS, jobs_path: str = JOBS_DB_PATH, catalog_path: str = CATALOG_PATH) -> None:
+    # Standalone worker process, can run next to (or instead of) the workers in the UI process
+    pool = IngestWorkerPool(jobs_path, num_workers, catalog_path=catalog_path).start()
+    try:
+        for thread in pool.threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+def jobs(jobs_path: str = JOBS_DB_PATH, limit: int = 50) -> None:
+    table = Table(title=f"Ingest jobs in {jobs_path}")
+    for column in ("id", "collection_name", "status", "stage", *PROGRESS_STAGES, "error"):
+        table.add_column(column)
+    for job in JobQueue(jobs_path).jobs(limit):
+        table.add_row(
+            *[str(job[key]) for key in ("id", "collection_name", "status", "stage")],
+            *[str(job["progress"].get(stage, 0)) for stage in PROGRESS_STAGES],
+            str(job["error"] or ""),
+        )
+    print(table)
+
+
+if __name__ == '__main__':
+    import typer
+
+    app = typer.Typer()
+    app.command()(run)
+    app.command()(jobs)
+    app()
@@ -0,0 +1,355 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+from qdrant_client.http import models
+
+from ai_search_demo.bm25 import rrf_fuse
+
+# Constants
+LOCAL_INDEX_DIR = "storage/local_index"
+LOCAL_INDEX_DTYPE = "float16"  # "float16" or "int8"
+SCORE_CHUNK_PAGES = 4096  # pages scored per matrix multiplication, bounds peak memory
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def maxsim_scores(queries, tokens: np.ndarray, offsets: np.ndarray, chunk_pages: int = SCORE_CHUNK_PAGES) -> np.ndarray:
+    """
+    Batched MaxSim with cosine similarity, the same scoring Qdrant uses for multivectors.
+    `tokens` holds the patch vectors of all pages back to back, page i owns rows
+    offsets[i]:offsets[i + 1]. Returns a (num_pages, num_queries) score matrix.
+    """
+    query_offsets = np.cumsum([0] + [len(query) for query in queries])
+    query_matrix = normalize(np.concatenate([np.asarray(query, dtype=np.float32) for query in queries]))
+    num_pages = len(offsets) - 1
+    scores = np.empty((num_pages, len(queries)), dtype=np.float32)
+    for start in range(0, num_pages, chunk_pages):
+        end = min(start + chunk_pages, num_pages)
+        block = tokens[offsets[start]:offsets[end]]
+        if block.dtype == np.int8:
+            block = block.astype(np.float32) / 127
+        similarities = block.astype(np.float32) @ query_matrix.T
+        # max over each page's tokens, then sum over each query's tokens
+        per_page = np.maximum.reduceat(similarities, offsets[start:end] - offsets[start], axis=0)
+        scores[start:end] = np.add.reduceat(per_page, query_offsets[:-1], axis=1)
+    return scores
+
+
+class LocalMaxSimClient:
+    """
+    In-process replacement for the parts of QdrantClient used by IngestClient and
+    SearchClient. Each upsert is written as a segment: a float16/int8 token matrix,
+    an offsets array and the ids/payloads, all memory-mapped at query time.
+    Deletes are written as tombstone segments. Writers in several processes are
+    serialized with a file lock, readers reload when meta.json changes.
+    Search is exact MaxSim over every page with NumPy. Sparse (BM25) vectors are kept
+    in the points file and scored with Qdrant's IDF modifier. A prefetch over the
+    multivector or a sparse vector limits the candidates, or is fused with RRF;
+    prefetches over other vectors (pooled) are ignored, MaxSim is exact anyway.
+    """
+
+    def __init__(self, path: str = LOCAL_INDEX_DIR, vector_name: str = None, dtype: str = LOCAL_INDEX_DTYPE):
+        self.path = Path(path)
+        self.vector_name = vector_name
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.postings = {}
+
+    def collection_dir(self, collection_name: str) -> Path:
+        return self.path / collection_name
+
+    def read_meta(self, collection_name: str) -> dict:
+        meta_path = self.collection_dir(collection_name) / "meta.json"
+        if not meta_path.exists():
+            raise ValueError(f"Collection '{collection_name}' not found in {self.path}")
+        return json.loads(meta_path.read_text())
+
+    def write_meta(self, collection_name: str, meta: dict):
+        meta_path = self.collection_dir(collection_name) / "meta.json"
+        tmp_path = meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, meta_path)
+
+    def meta_version(self, collection_name: str) -> tuple:
+        # meta.json is replaced on every write, so its inode and mtime change with each new segment,
+        # also when another client or process wrote it
+        stat = (self.collection_dir(collection_name) / "meta.json").stat()
+        return stat.st_ino, stat.st_mtime_ns
+
+    @contextmanager
+    def writer_lock(self, collection_name: str):
+        # Writers in other processes take the same file lock, segment numbers are never reused
+        with self.lock, open(self.collection_dir(collection_name) / "write.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def collection_exists(self, collection_name: str) -> bool:
+        return (self.collection_dir(collection_name) / "meta.json").exists()
+
+    def create_collection(self, collection_name: str, vectors_config=None, sparse_vectors_config=None, **kwargs):
+        # The lock file lives in the collection dir, the check and the first meta.json are written under it,
+        # so a concurrent create can't reset the segment count of a collection another process writes to
+        self.collection_dir(collection_name).mkdir(parents=True, exist_ok=True)
+        vector_names = list(vectors_config) if isinstance(vectors_config, dict) else []
+        with self.writer_lock(collection_name):
+            if self.collection_exists(collection_name):
+                raise ValueError(f"Collection '{collection_name}' already exists")
+            self.write_meta(collection_name, {
+                "vector_names": vector_names,
+                "sparse_vector_names": list(sparse_vectors_config or {}),
+                "dtype": self.dtype,
+                "segments": 0,
+            })
+        return True
+
+    def delete_collection(self, collection_name: str, **kwargs) -> bool:
+        if not self.collection_exists(collection_name):
+            return False
+        collection_dir = self.collection_dir(collection_name)
+        with self.writer_lock(collection_name):
+            # meta.json first, readers see a missing collection rather than missing segments
+            (collection_dir / "meta.json").unlink()
+            for path in collection_dir.iterdir():
+                if path.name != "write.lock":
+                    path.unlink()
+        with self.lock:
+            self.segments.pop(collection_name, None)
+            self.postings.pop(collection_name, None)
+        return True
+
+    def get_collection(self, collection_name: str):
+        # Only the fields read by SearchClient are filled in
+        meta = self.read_meta(collection_name)
+        vectors = dict.fromkeys(meta["vector_names"]) if meta["vector_names"] else None
+        sparse_vectors = dict.fromkeys(meta.get("sparse_vector_names", [])) or None
+        points_count = sum(int(segment[-1].sum()) for segment in self.load_segments(collection_name))
+        params = SimpleNamespace(vectors=vectors, sparse_vectors=sparse_vectors)
+        return SimpleNamespace(config=SimpleNamespace(params=params), points_count=points_count)
+
+    def sparse_vectors(self, point: models.PointStruct) -> dict:
+        if not isinstance(point.vector, dict):
+            return {}
+        return {
+            name: [vector.indices, vector.values]
+            for name, vector in point.vector.items() if isinstance(vector, models.SparseVector)
+        }
+
+    def multivector(self, point: models.PointStruct):
+        if isinstance(point.vector, dict):
+            return point.vector[self.vector_name]
+        return point.vector
+
+    def upsert(self, collection_name: str, points, wait: bool = True, **kwargs):
+        dtype = self.read_meta(collection_name)["dtype"]
+        vectors = [normalize(np.asarray(self.multivector(point), dtype=np.float32)) for point in points]
+        tokens = np.concatenate(vectors)
+        tokens = np.round(tokens * 127).astype(np.int8) if dtype == "int8" else tokens.astype(np.float16)
+        offsets = np.cumsum([0] + [len(vector) for vector in vectors])
+
+        collection_dir = self.collection_dir(collection_name)
+        with self.writer_lock(collection_name):
+            meta = self.read_meta(collection_name)
+            segment = meta["segments"]
+            np.save(collection_dir / f"segment_{segment}_tokens.npy", tokens)
+            np.save(collection_dir / f"segment_{segment}_offsets.npy", offsets)
+            (collection_dir / f"segment_{segment}_points.json").write_text(
+                json.dumps({
+                    "ids": [point.id for point in points],
+                    "payloads": [point.payload for point in points],
+                    "sparse": [self.sparse_vectors(point) for point in points],
+                })
+            )
+            meta["segments"] = segment + 1
+            self.write_meta(collection_name, meta)
+        return models.UpdateResult(operation_id=segment, status=models.UpdateStatus.COMPLETED)
+
+    def delete(self, collection_name: str, points_selector: models.PointIdsList, **kwargs):
+        # Deletes are tombstone segments without vectors, they hide earlier upserts of the same ids
+        with self.writer_lock(collection_name):
+            meta = self.read_meta(collection_name)
+            segment = meta["segments"]
+            (self.collection_dir(collection_name) / f"segment_{segment}_points.json").write_text(
+                json.dumps({"ids": list(points_selector.points), "deleted": True})
+            )
+            meta["segments"] = segment + 1
+            self.write_meta(collection_name, meta)
+        return models.UpdateResult(operation_id=segment, status=models.UpdateStatus.COMPLETED)
+
+    def retrieve(self, collection_name: str, ids, with_payload: bool = True, with_vectors: bool = False, **kwargs):
+        wanted = set(ids)
+        records = []
+        for _, _, segment_ids, payloads, _, live in self.load_segments(collection_name):
+            for point_id, payload, is_live in zip(segment_ids, payloads, live):
+                if is_live and point_id in wanted:
+                    records.append(models.Record(id=point_id, payload=payload if with_payload else None))
+        return records
+
+    def load_segments(self, collection_name: str):
+        """Returns [(tokens, offsets, ids, payloads, sparse, live_mask)], later upserts of an id hide earlier ones."""
+        with self.lock:
+            version = self.meta_version(collection_name)
+            cached_version, segments = self.segments.get(collection_name, (None, None))
+            if cached_version == version:
+                return segments
+            collection_dir = self.collection_dir(collection_name)
+            segments = []
+            seen_ids = set()
+            for segment in reversed(range(self.read_meta(collection_name)["segments"])):
+                points = json.loads((collection_dir / f"segment_{segment}_points.json").read_text())
+                if points.get("deleted"):
+                    seen_ids.update(points["ids"])
+                    continue
+                tokens = np.load(collection_dir / f"segment_{segment}_tokens.npy", mmap_mode="r")
+                offsets = np.load(collection_dir / f"segment_{segment}_offsets.npy")
+                live = np.array([point_id not in seen_ids for point_id in points["ids"]], dtype=bool)
+                seen_ids.update(points["ids"])
+                # Segments written before sparse vectors were stored have none
+                sparse = points.get("sparse", [{}] * len(points["ids"]))
+                segments.append((tokens, offsets, points["ids"], points["payloads"], sparse, live))
+            segments.reverse()
+            self.segments[collection_name] = (version, segments)
+            return segments
+
+    def points(self, collection_name: str):
+        """Ids, payloads and live mask of every stored page, in the row order of the score matrices."""
+        ids, payloads, live = [], [], []
+        for _, _, segment_ids, segment_payloads, _, segment_live in self.load_segments(collection_name):
+            ids.extend(segment_ids)
+            payloads.extend(segment_payloads)
+            live.append(segment_live)
+        return ids, payloads, np.concatenate(live) if live else np.zeros(0, dtype=bool)
+
+    def multivector_scores(self, collection_name: str, queries) -> np.ndarray:
+        """(num_pages, num_queries) MaxSim scores, -inf for deleted pages."""
+        all_scores = []
+        for tokens, offsets, _, _, _, live in self.load_segments(collection_name):
+            scores = maxsim_scores(queries, tokens, offsets)
+            scores[~live] = -np.inf
+            all_scores.append(scores)
+        return np.concatenate(all_scores) if all_scores else np.zeros((0, len(queries)), dtype=np.float32)
+
+    def text_postings(self, collection_name: str, using: str) -> dict:
+        # term -> (page rows, weights), built once per collection version
+        segments = self.load_segments(collection_name)
+        with self.lock:
+            version = self.segments[collection_name][0]
+            cached_version, cached = self.postings.get(collection_name, (None, {}))
+            if cached_version == version and using in cached:
+                return cached[using]
+        postings = {}
+        row = 0
+        for segment in segments:
+            for page_sparse in segment[4]:
+                indices, values = page_sparse.get(using, ([], []))
+                for index, value in zip(indices, values):
+                    postings.setdefault(index, ([], []))
+                    postings[index][0].append(row)
+                    postings[index][1].append(value)
+                row += 1
+        postings = {index: (np.array(rows), np.array(values, dtype=np.float32)) for index, (rows, values) in postings.items()}
+        with self.lock:
+            cached_version, cached = self.postings.get(collection_name, (None, {}))
+            self.postings[collection_name] = (version, {**cached, using: postings} if cached_version == version else {using: postings})
+        return postings
+
+    def sparse_scores(self, collection_name: str, query: models.SparseVector, using: str) -> np.ndarray:
+        """Dot product with IDF weighting like Qdrant's Modifier.IDF, -inf for pages without a query term."""
+        _, _, live = self.points(collection_name)
+        postings = self.text_postings(collection_name, using)
+        num_live = int(live.sum())
+        scores = np.zeros(len(live), dtype=np.float32)
+        matched = np.zeros(len(live), dtype=bool)
+        for index, query_value in zip(query.indices, query.values):
+            if index not in postings:
+                continue
+            rows, values = postings[index]
+            doc_frequency = int(live[rows].sum())
+            idf = np.log((num_live - doc_frequency + 0.5) / (doc_frequency + 0.5) + 1)
+            scores[rows] += query_value * idf * values
+            matched[rows] = True
+        scores[~(matched & live)] = -np.inf
+        return scores
+
+    def query_scores(self, collection_name: str, query, using: str = None) -> np.ndarray:
+        if isinstance(query, models.SparseVector):
+            return self.sparse_scores(collection_name, query, using)
+        return self.multivector_scores(collection_name, [query])[:, 0]
+
+    def is_stored(self, collection_name: str, using: str) -> bool:
+        return using is None or using == self.vector_name or using in self.read_meta(collection_name).get("sparse_vector_names", [])
+
+    def scored_points(self, collection_name: str, rows, scores) -> models.QueryResponse:
+        ids, payloads, _ = self.points(collection_name)
+        return models.QueryResponse(points=[
+            models.ScoredPoint(id=ids[row], version=0, score=float(score), payload=payloads[row]) for row, score in zip(rows, scores)
+        ])
+
+    def search(self, collection_name: str, queries, limit: int):
+        """Exact MaxSim top-`limit` for a batch of multivector queries."""
+        scores = self.multivector_scores(collection_name, queries)
+        responses = []
+        for query_scores in scores.T:
+            top = top_rows(query_scores, limit)
+            responses.append(self.scored_points(collection_name, top, query_scores[top]))
+        return responses
+
+    def query_points(self, collection_name: str, query=None, using: str = None, prefetch=None, limit: int = 10, **kwargs):
+        candidates = [
+            top_rows(self.query_scores(collection_name, item.query, item.using), item.limit)
+            for item in self.prefetches(collection_name, prefetch)
+        ]
+        if isinstance(query, models.FusionQuery):
+            fused = rrf_fuse([rows.tolist() for rows in candidates], limit)
+            return self.scored_points(collection_name, [row for row, _ in fused], [score for _, score in fused])
+        scores = self.query_scores(collection_name, query, using)
+        if candidates:
+            allowed = np.zeros(len(scores), dtype=bool)
+            for rows in candidates:
+                allowed[rows] = True
+            scores[~allowed] = -np.inf
+        top = top_rows(scores, limit)
+        return self.scored_points(collection_name, top, scores[top])
+
+    def prefetches(self, collection_name: str, prefetch) -> list:
+        # Only prefetches over stored vectors change the result, see the class docstring
+        prefetches = prefetch if isinstance(prefetch, list) else [prefetch] if prefetch is not None else []
+        return [item for item in prefetches if self.is_stored(collection_name, item.using)]
+
+    def query_batch_points(self, collection_name: str, requests, **kwargs):
+        # Plain multivector requests are scored together in one pass over the token matrix
+        responses = [None] * len(requests)
+        plain = [
+            i for i, request in enumerate(requests)
+            if not self.prefetches(collection_name, request.prefetch) and not isinstance(request.query, (models.SparseVector, models.FusionQuery))
+        ]
+        if plain:
+            limit = max(requests[i].limit for i in plain)
+            for i, response in zip(plain, self.search(collection_name, [requests[i].query for i in plain], limit)):
+                responses[i] = models.QueryResponse(points=response.points[:requests[i].limit])
+        for i, request in enumerate(requests):
+            if responses[i] is None:
+                responses[i] = self.query_points(
+                    collection_name, query=request.query, using=request.using, prefetch=request.prefetch, limit=request.limit
+                )
+        return responses
+
+
+def top_rows(scores: np.ndarray, limit: int) -> np.ndarray:
+    """Rows of the `limit` best finite scores, best first."""
+    k = min(limit, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return np.array([], dtype=int)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
@@ -1,151 +1,773 @@
+import hashlib
 import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
 import tracemalloc
+import uuid
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+import PIL.Image
+import pypdfium2 as pdfium
+import httpx
 import requests
-from datasets import Dataset
+from datasets import Dataset, Features, Image, Value, concatenate_datasets
 from pdf2image import convert_from_path
 from pypdf import PdfReader
 from qdrant_client import QdrantClient
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
 from qdrant_client.http import models
 from tqdm import tqdm
 
+from ai_search_demo.bm25 import bm25_document_vector, bm25_query_vector
+from ai_search_demo.cache import QueryEmbeddingCache
+from ai_search_demo.local_index import LocalMaxSimClient
+
 # Constants
 COLPALI_BASE_URL = "https://truskovskiyk--colpali-embedding-serve.modal.run"
 COLPALI_TOKEN = "super-secret-token"
+COLPALI_MODEL_NAME = "vidore/colqwen2-v1.0-merged"
+EMBEDDING_WIRE_FORMAT = "float16"  # "float16" or "float32" binary NumPy responses, or "json"
+NPY_MEDIA_TYPE = "application/x-npy"
+NPZ_MEDIA_TYPE = "application/x-npz"
 QDRANT_URI = "https://qdrant.up.railway.app"
 QDRANT_PORT = 443
+QDRANT_GRPC_PORT = 6334
+QDRANT_PREFER_GRPC = False  # gRPC transport for Qdrant calls, the server must expose QDRANT_GRPC_PORT
+QDRANT_POOL_SIZE = 8  # keep-alive connections to Qdrant (REST)
+COLPALI_POOL_SIZE = 8  # keep-alive connections to the ColPali server
+VECTOR_BACKEND = "qdrant"  # "qdrant" (remote server at QDRANT_URI) or "local" (NumPy MaxSim, see local_index.py)
 VECTOR_SIZE = 128
 INDEXING_THRESHOLD = 100
 QUANTILE = 0.99
 TOP_K = 5
+MULTIVECTOR_NAME = "colpali"
+POOLED_VECTOR_NAME = "mean_pooling"
+TEXT_VECTOR_NAME = "bm25"  # sparse BM25 vector of the page text
+# "multivector" (full MaxSim), "two_stage" (pooled prefetch + MaxSim rerank),
+# "hybrid" (BM25 and MaxSim fused with RRF) or "lexical_rerank" (BM25 prefetch + MaxSim rerank)
+SEARCH_MODE = "multivector"
+SEARCH_MODES = ["multivector", "two_stage", "hybrid", "lexical_rerank"]
+PREFETCH_LIMIT = 100
+QUERY_EMBED_BATCH_SIZE = 64  # queries per ColPali request, the server's MAX_QUERY_BATCH_SIZE
+SEARCH_BATCH_SIZE = 64  # searches per Qdrant query_batch_points request
+SEARCH_MAX_IN_FLIGHT = 4  # concurrent embedding / batch search requests in search_images_by_texts
+POOL_FACTOR = 1  # > 1 clusters page patch embeddings down to ~1/POOL_FACTOR vectors at ingest
+EMBED_BATCH_SIZE = 8
+UPSERT_BATCH_SIZE = 32
+UPSERT_MAX_BATCH_BYTES = 16 * 1024 * 1024
+UPSERT_MAX_IN_FLIGHT = 4
+UPSERT_MAX_RETRIES = 3
+UPSERT_RETRY_BACKOFF = 1.0
+EMBED_MAX_RETRIES = 3
+PDF_DPI = 150
+PDF_JPEG_OPTIONS = {"quality": 100, "progressive": True, "optimize": True}
+COLQWEN2_MAX_PIXELS = 768 * 28 * 28  # ColQwen2Processor downscales bigger images to this many pixels
+UPLOAD_MAX_PIXELS = None  # e.g. COLQWEN2_MAX_PIXELS to downscale pages on the client before upload
+UPLOAD_JPEG_QUALITY = 90  # only used when a page has to be re-encoded
+UPLOAD_RESAMPLE = PIL.Image.Resampling.BILINEAR
+PDF_BACKEND = "poppler"  # "poppler" (pypdf + pdf2image) or "pdfium" (one pypdfium2 handle for text and rendering)
+RENDER_WORKERS = os.cpu_count() or 1
+RENDER_PAGES_PER_TASK = 8
+DATASET_WRITER_BATCH_SIZE = 16  # pages buffered in memory before an Arrow write
+THUMBNAIL_SIZE = (512, 512)
+THUMBNAIL_JPEG_QUALITY = 85
+PAGE_FEATURES = Features({
+    "image": Image(),
+    "index": Value("int64"),
+    "pdf_name": Value("string"),
+    "pdf_page": Value("int64"),
+    "page_text": Value("string"),
+    "pdf_sha256": Value("string"),
+})
+PAGE_ID_NAMESPACE = uuid.UUID("6f1d7c1e-2a4b-4c0e-9a53-3d1f0c6b8e21")
+
+
+def pil_to_jpeg_bytes(pil_image, **save_options) -> bytes:
+    buffered = io.BytesIO()
+    pil_image.save(buffered, format="JPEG", **save_options)
+    return buffered.getvalue()
+
+
+def image_upload_bytes(image, max_pixels: int = UPLOAD_MAX_PIXELS) -> bytes:
+    """
+    JPEG bytes to upload to ColPali for a dataset image, either a PIL image or an
+    undecoded {"bytes", "path"} row (datasets Image(decode=False)). Source JPEGs that
+    are small enough are sent as they are, without decoding or re-encoding.
+    Bigger pages are downscaled to about `max_pixels`, JPEGs are decoded at reduced
+    scale (PIL draft mode) first so only the last step is a real resize.
+    """
+    if isinstance(image, dict):
+        source = image["bytes"] if image["bytes"] is not None else Path(image["path"]).read_bytes()
+        # Image.open only parses the header here, pixels are decoded lazily
+        image = PIL.Image.open(io.BytesIO(source))
+        if image.format == "JPEG" and (max_pixels is None or image.width * image.height <= max_pixels):
+            return source
+    if max_pixels is None or image.width * image.height <= max_pixels:
+        return pil_to_jpeg_bytes(image if image.mode in ("RGB", "L") else image.convert("RGB"))
+
+    scale = (max_pixels / (image.width * image.height)) ** 0.5
+    size = (max(int(image.width * scale), 1), max(int(image.height * scale), 1))
+    image.draft("RGB", size)  # no-op for already decoded or non-JPEG images
+    image = image.convert("RGB").resize(size, UPLOAD_RESAMPLE, reducing_gap=2.0)
+    return pil_to_jpeg_bytes(image, quality=UPLOAD_JPEG_QUALITY)
+
+
+def embedding_headers(wire_format: str = EMBEDDING_WIRE_FORMAT) -> dict:
+    # Content negotiation: ask for .npy/.npz bodies in the given dtype instead of JSON lists
+    if wire_format == "json":
+        return {}
+    return {"Accept": f"{NPY_MEDIA_TYPE}; dtype={wire_format}, {NPZ_MEDIA_TYPE}; dtype={wire_format}, application/json;q=0.5"}
+
+
+def decode_embedding_response(response) -> dict:
+    """
+    Decodes a ColPali server response (requests or httpx) into {"embedding": ndarray}
+    or {"embeddings": [ndarray, ...]}. Servers without binary support answer JSON,
+    which is returned as is.
+    """
+    content_type = response.headers.get("content-type", "")
+    if content_type.startswith(NPY_MEDIA_TYPE):
+        return {"embedding": np.load(io.BytesIO(response.content), allow_pickle=False)}
+    if content_type.startswith(NPZ_MEDIA_TYPE):
+        with np.load(io.BytesIO(response.content), allow_pickle=False) as arrays:
+            return {"embeddings": [arrays[f"arr_{i}"] for i in range(len(arrays.files))]}
+    return response.json()
+
+
+def create_http_session(pool_size: int) -> requests.Session:
+    # Connections (and their TLS handshakes) are reused between requests, up to pool_size per host
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
 class ColPaliClient:
-    def __init__(self, base_url: str = COLPALI_BASE_URL, token: str = COLPALI_TOKEN):
+    def __init__(
+        self,
+        base_url: str = COLPALI_BASE_URL,
+        token: str = COLPALI_TOKEN,
+        wire_format: str = EMBEDDING_WIRE_FORMAT,
+        pool_size: int = COLPALI_POOL_SIZE,
+    ):
         self.base_url = base_url
-        self.headers = {"Authorization": f"Bearer {token}"}
+        self.headers = {"Authorization": f"Bearer {token}", **embedding_headers(wire_format)}
+        self.session = create_http_session(pool_size)
 
     def query_text(self, query_text: str):
-        response = requests.post(
+        response = self.session.post(
             f"{self.base_url}/query",
             headers=self.headers,
             params={"query_text": query_text}
         )
         response.raise_for_status()
-        return response.json()
+        return decode_embedding_response(response)
+
+    def query_texts(self, query_texts):
+        # All queries in one request, the server embeds them as one batch
+        response = self.session.post(
+            f"{self.base_url}/queries",
+            headers=self.headers,
+            json=list(query_texts),
+        )
+        response.raise_for_status()
+        return decode_embedding_response(response)
 
     def process_image(self, image_path: str):
         with open(image_path, "rb") as image_file:
             files = {"image": image_file}
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/process_image",
                 files=files,
                 headers=self.headers
             )
             response.raise_for_status()
-            return response.json()
+            return decode_embedding_response(response)
 
     def process_pil_image(self, pil_image):
-        buffered = io.BytesIO()
-        pil_image.save(buffered, format="JPEG")
-        files = {"image": buffered.getvalue()}
-        response = requests.post(
+        return self.process_image_bytes(pil_to_jpeg_bytes(pil_image))
+
+    def process_pil_images(self, pil_images):
+        return self.process_images_bytes([pil_to_jpeg_bytes(pil_image) for pil_image in pil_images])
+
+    def process_image_bytes(self, image_bytes: bytes):
+        files = {"image": image_bytes}
+        response = self.session.post(
             f"{self.base_url}/process_image",
             files=files,
             headers=self.headers
         )
         response.raise_for_status()
-        return response.json()
-        
+        return decode_embedding_response(response)
 
-class IngestClient:
-    def __init__(self, qdrant_uri: str = QDRANT_URI):
-        self.qdrant_client = QdrantClient(qdrant_uri, port=QDRANT_PORT, https=True)
-        self.colpali_client = ColPaliClient()
+    def process_images_bytes(self, images_bytes):
+        # Send all images in one multipart request, the server embeds them as one batch
+        files = []
+        for i, image_bytes in enumerate(images_bytes):
+            files.append(("images", (f"image_{i}.jpg", image_bytes, "image/jpeg")))
+        response = self.session.post(
+            f"{self.base_url}/process_images",
+            files=files,
+            headers=self.headers
+        )
+        response.raise_for_status()
+        return decode_embedding_response(response)
 
-    def ingest(self, collection_name, dataset):
-        self.qdrant_client.create_collection(
-            collection_name=collection_name,
-            on_disk_payload=True,
-            optimizers_config=models.OptimizersConfigDiff(
-                indexing_threshold=INDEXING_THRESHOLD
-            ),
-            vectors_config=models.VectorParams(
+
+def estimate_point_bytes(vector) -> int:
+    # Rough float32 size of a (multi)vector, used for the upsert byte budget
+    if vector and isinstance(vector[0], list):
+        return sum(len(v) for v in vector) * 4
+    return len(vector) * 4
+
+
+class BatchUploader:
+    """
+    Collects points into batches (by count or byte budget) and upserts them to Qdrant
+    from a background thread pool. At most `max_in_flight` batches are pending at once,
+    `add` blocks when that limit is reached. Failed batches are retried with backoff,
+    points that still fail end up in `failed_ids` and are passed to `on_failed`.
+    """
+
+    def __init__(
+        self,
+        qdrant_client: QdrantClient,
+        collection_name: str,
+        batch_size: int = UPSERT_BATCH_SIZE,
+        max_batch_bytes: int = UPSERT_MAX_BATCH_BYTES,
+        max_in_flight: int = UPSERT_MAX_IN_FLIGHT,
+        max_retries: int = UPSERT_MAX_RETRIES,
+        on_uploaded=None,
+        on_failed=None,
+    ):
+        self.qdrant_client = qdrant_client
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.on_uploaded = on_uploaded
+        self.on_failed = on_failed
+
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.batch = []
+        self.batch_bytes = 0
+        self.uploaded = 0
+        self.failed_ids = []
+
+    def add(self, point: models.PointStruct, num_bytes: int = 0):
+        self.batch.append(point)
+        self.batch_bytes += num_bytes
+        if len(self.batch) >= self.batch_size or self.batch_bytes >= self.max_batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        points, self.batch, self.batch_bytes = self.batch, [], 0
+        # Blocks while max_in_flight batches are still being uploaded (backpressure)
+        self.in_flight.acquire()
+        self.futures.append(self.executor.submit(self._upload, points))
+
+    def _upload(self, points):
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.qdrant_client.upsert(
+                        collection_name=self.collection_name,
+                        points=points,
+                        wait=True,
+                    )
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        print(f"Error during upsert of {len(points)} points, giving up: {e}")
+                        with self.lock:
+                            self.failed_ids.extend(point.id for point in points)
+                        if self.on_failed is not None:
+                            self.on_failed(points, e)
+                        return
+                    print(f"Error during upsert (attempt {attempt + 1}/{self.max_retries + 1}): {e}")
+                    time.sleep(UPSERT_RETRY_BACKOFF * 2**attempt)
+
+            with self.lock:
+                self.uploaded += len(points)
+            if self.on_uploaded is not None:
+                self.on_uploaded(points)
+        finally:
+            self.in_flight.release()
+
+    def close(self):
+        self.flush()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+
+
+def collection_config() -> dict:
+    # Shared by the sync and async ingest clients
+    quantization_config = models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            quantile=QUANTILE,
+            always_ram=True,
+        ),
+    )
+    return dict(
+        on_disk_payload=True,
+        optimizers_config=models.OptimizersConfigDiff(
+            indexing_threshold=INDEXING_THRESHOLD
+        ),
+        vectors_config={
+            MULTIVECTOR_NAME: models.VectorParams(
                 size=VECTOR_SIZE,
                 distance=models.Distance.COSINE,
                 multivector_config=models.MultiVectorConfig(
                     comparator=models.MultiVectorComparator.MAX_SIM
                 ),
-                quantization_config=models.ScalarQuantization(
-                    scalar=models.ScalarQuantizationConfig(
-                        type=models.ScalarType.INT8,
-                        quantile=QUANTILE,
-                        always_ram=True,
-                    ),
-                ),
+                quantization_config=quantization_config,
+            ),
+            # One vector per page, cheap to search with HNSW, used as the first stage of two_stage search
+            POOLED_VECTOR_NAME: models.VectorParams(
+                size=VECTOR_SIZE,
+                distance=models.Distance.COSINE,
+                quantization_config=quantization_config,
             ),
+        },
+        # Term weights are stored per page, Qdrant applies IDF over the collection at query time
+        sparse_vectors_config={
+            TEXT_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF),
+        },
+    )
+
+
+def has_named_vectors(collection_info) -> bool:
+    # Collections created before named vectors have a single unnamed multivector, points for them can't be upserted
+    vectors = collection_info.config.params.vectors
+    return isinstance(vectors, dict) and MULTIVECTOR_NAME in vectors
+
+
+def legacy_collection_error(collection_name: str) -> ValueError:
+    return ValueError(
+        f"Collection '{collection_name}' was created before named vectors and can't be appended to, "
+        "ingest into a new collection or re-upload the PDFs in the UI to migrate it"
+    )
+
+
+def mean_pool(multivector):
+    return np.asarray(multivector, dtype=np.float32).mean(axis=0).tolist()
+
+
+def pool_multivector(multivector, pool_factor: int = POOL_FACTOR):
+    """
+    Hierarchical token pooling: cluster the patch embeddings of a page by cosine
+    distance (Ward linkage) into len(multivector) // pool_factor groups and keep
+    the mean of each group.
+    """
+    vectors = np.asarray(multivector, dtype=np.float32)
+    max_clusters = max(len(vectors) // pool_factor, 1)
+    if pool_factor <= 1 or len(vectors) <= max_clusters:
+        return vectors.tolist()
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+    distances = np.clip(1 - normalized @ normalized.T, 0, None)
+    np.fill_diagonal(distances, 0)
+    clusters = fcluster(linkage(squareform(distances, checks=False), method="ward"), t=max_clusters, criterion="maxclust")
+    return np.stack([vectors[clusters == cluster].mean(axis=0) for cluster in np.unique(clusters)]).tolist()
+
+
+def page_vectors(image_embedding, pool_factor: int = POOL_FACTOR, page_text: str = None) -> dict:
+    # Named vectors stored for every page, the pooled vector is computed from the uncompressed tokens
+    vectors = {
+        MULTIVECTOR_NAME: pool_multivector(image_embedding, pool_factor),
+        POOLED_VECTOR_NAME: mean_pool(image_embedding),
+    }
+    # Pages without extractable text (scans) are only found by the image vectors
+    text_vector = bm25_document_vector(page_text)
+    if text_vector.indices:
+        vectors[TEXT_VECTOR_NAME] = text_vector
+    return vectors
+
+
+def file_sha256(path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def page_point_id(pdf_sha256: str, pdf_page: int) -> str:
+    # Same PDF content and page always map to the same point, whatever the file or collection
+    return str(uuid.uuid5(PAGE_ID_NAMESPACE, f"{pdf_sha256}:{pdf_page}"))
+
+
+def row_point_ids(rows, start: int):
+    # rows is a dataset slice (dict of columns), datasets without pdf_sha256 keep positional ids
+    if "pdf_sha256" in rows:
+        return [page_point_id(pdf_sha256, pdf_page) for pdf_sha256, pdf_page in zip(rows["pdf_sha256"], rows["pdf_page"])]
+    return list(range(start, start + len(rows["pdf_page"])))
+
+
+def row_page_text(rows, offset: int):
+    # Datasets from pdfs_to_hf_dataset have the extracted page text, others (e.g. synthetic evaluation sets) may not
+    return rows["page_text"][offset] if "page_text" in rows else None
+
+
+def row_payload(rows, offset: int) -> dict:
+    payload = {
+        "index": rows['index'][offset],
+        "pdf_name": rows['pdf_name'][offset],
+        "pdf_page": rows['pdf_page'][offset],
+    }
+    if "pdf_sha256" in rows:
+        payload["pdf_sha256"] = rows['pdf_sha256'][offset]
+    return payload
+
+
+def create_vector_client(backend: str = VECTOR_BACKEND, qdrant_uri: str = QDRANT_URI, prefer_grpc: bool = QDRANT_PREFER_GRPC):
+    # Both backends expose the QdrantClient methods used by IngestClient and SearchClient
+    if backend == "local":
+        return LocalMaxSimClient(vector_name=MULTIVECTOR_NAME)
+    if backend == "qdrant":
+        return QdrantClient(
+            qdrant_uri,
+            port=QDRANT_PORT,
+            grpc_port=QDRANT_GRPC_PORT,
+            prefer_grpc=prefer_grpc,
+            https=True,
+            # passed on to the httpx client of the REST transport
+            limits=httpx.Limits(max_connections=QDRANT_POOL_SIZE, max_keepalive_connections=QDRANT_POOL_SIZE),
         )
+    raise ValueError(f"Unknown vector backend: {backend}")
 
-        # Use tqdm to create a progress bar
-        with tqdm(total=len(dataset), desc="Indexing Progress") as pbar:
-            for i in range(len(dataset)):
-                # The images are already PIL Image objects, so we can use them directly
-                image = dataset[i]["image"]
-
-                # Process and encode image using ColPaliClient
-                response = self.colpali_client.process_pil_image(image)
-                image_embedding = response['embedding']
-
-                # Prepare point for Qdrant
-                point = models.PointStruct(
-                    id=i,  # we just use the index as the ID
-                    vector=image_embedding,  # This is now a list of vectors
-                    payload={
-                        "index": dataset[i]['index'],
-                        "pdf_name": dataset[i]['pdf_name'],
-                        "pdf_page": dataset[i]['pdf_page'],
-                    },  # can also add other metadata/data
-                )
 
-                # Upload point to Qdrant
-                try:
-                    self.qdrant_client.upsert(
-                        collection_name=collection_name,
-                        points=[point],
-                        wait=False,
-                    )                    
-                # clown level error handling here 🤡
-                except Exception as e:
-                    print(f"Error during upsert: {e}")
-                    continue
+class IngestClient:
+    def __init__(self, qdrant_uri: str = QDRANT_URI, backend: str = VECTOR_BACKEND, prefer_grpc: bool = QDRANT_PREFER_GRPC):
+        self.qdrant_client = create_vector_client(backend, qdrant_uri, prefer_grpc)
+        self.colpali_client = ColPaliClient()
+
+    def create_collection(self, collection_name):
+        self.qdrant_client.create_collection(collection_name=collection_name, **collection_config())
+
+    def existing_point_ids(self, collection_name, point_ids) -> set:
+        points = self.qdrant_client.retrieve(collection_name, ids=point_ids, with_payload=False, with_vectors=False)
+        return {point.id for point in points}
+
+    def delete_points(self, collection_name, point_ids):
+        # Used to drop pages of PDFs that were replaced by a new version
+        if point_ids:
+            self.qdrant_client.delete(collection_name, points_selector=models.PointIdsList(points=point_ids))
+
+    def embed_images(self, images_bytes, max_retries: int = EMBED_MAX_RETRIES):
+        # Retries cover network blips and ColPali cold starts
+        for attempt in range(max_retries + 1):
+            try:
+                return self.colpali_client.process_images_bytes(images_bytes)['embeddings']
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                print(f"Error during embedding (attempt {attempt + 1}/{max_retries + 1}): {e}")
+                time.sleep(UPSERT_RETRY_BACKOFF * 2**attempt)
+
+    def ingest(
+        self,
+        collection_name,
+        dataset,
+        batch_size: int = UPSERT_BATCH_SIZE,
+        max_batch_bytes: int = UPSERT_MAX_BATCH_BYTES,
+        max_in_flight: int = UPSERT_MAX_IN_FLIGHT,
+        max_retries: int = UPSERT_MAX_RETRIES,
+        embed_batch_size: int = EMBED_BATCH_SIZE,
+        pool_factor: int = POOL_FACTOR,
+        max_pixels: int = UPLOAD_MAX_PIXELS,
+        skip_existing: bool = True,
+        exclude_point_ids=(),
+        journal=None,
+        on_progress=None,
+    ):
+        """
+        With a `journal` (see ingest_job.IngestJournal) pages acknowledged by Qdrant are
+        checkpointed, pages already done or dead-lettered in it are skipped, and a batch
+        that still fails to embed after retries is dead-lettered instead of aborting.
+        `dead_letters` in the returned stats counts new and earlier dead-lettered pages.
+        `on_progress(stage, pages)` is called with "skipped", "embedded", "upserted" and "failed" page counts.
+        """
+        def progress(stage, pages):
+            if on_progress is not None and pages:
+                on_progress(stage, pages)
+
+        # Appending to an existing collection is fine, pages already in it are skipped
+        if not self.qdrant_client.collection_exists(collection_name):
+            self.create_collection(collection_name)
+        elif not has_named_vectors(self.qdrant_client.get_collection(collection_name)):
+            raise legacy_collection_error(collection_name)
 
-                # Update the progress bar
-                pbar.update(1)
+        # Metadata columns are cheap to read, images are only decoded for pages that need embedding
+        exclude_point_ids = set(exclude_point_ids)
+        dead_letter_ids = set()
+        if journal is not None:
+            exclude_point_ids |= journal.finished_point_ids()
+            dead_letter_ids = journal.failed_point_ids()
+        embed_failed_ids = []
+        metadata = dataset.remove_columns(["image"])
+        # Undecoded rows, so source JPEG bytes can be uploaded without a decode/encode round trip
+        images_column = dataset.select_columns(["image"]).cast_column("image", Image(decode=False))
+        skipped, dead_lettered = 0, 0
+        tokens_before, tokens_after = 0, 0
+        start_time = time.perf_counter()
+        # Use tqdm to create a progress bar, it advances when Qdrant acknowledges a batch
+        with tqdm(total=len(dataset), desc="Indexing Progress", unit="page") as pbar:
+            def on_uploaded(points):
+                if journal is not None:
+                    journal.mark_done(points)
+                progress("upserted", len(points))
+                pbar.update(len(points))
 
-        print("Indexing complete!")           
+            def on_failed(points, error):
+                if journal is not None:
+                    journal.mark_failed(points, error)
+                progress("failed", len(points))
+
+            uploader = BatchUploader(
+                self.qdrant_client,
+                collection_name,
+                batch_size=batch_size,
+                max_batch_bytes=max_batch_bytes,
+                max_in_flight=max_in_flight,
+                max_retries=max_retries,
+                on_uploaded=on_uploaded,
+                on_failed=on_failed,
+            )
+            try:
+                for start in range(0, len(dataset), embed_batch_size):
+                    rows = metadata[start:start + embed_batch_size]
+                    point_ids = row_point_ids(rows, start)
+                    # exclude_point_ids are rows of replaced PDF versions (see update_pdfs_hf_dataset)
+                    offsets = [offset for offset in range(len(point_ids)) if point_ids[offset] not in exclude_point_ids]
+                    if skip_existing and offsets:
+                        existing = self.existing_point_ids(collection_name, [point_ids[offset] for offset in offsets])
+                        offsets = [offset for offset in offsets if point_ids[offset] not in existing]
+                    # Pages dead-lettered by an earlier run are still failed, not indexed
+                    earlier_failed = sum(point_id in dead_letter_ids for point_id in point_ids)
+                    dead_lettered += earlier_failed
+                    skipped += len(point_ids) - len(offsets) - earlier_failed
+                    progress("skipped", len(point_ids) - len(offsets) - earlier_failed)
+                    progress("failed", earlier_failed)
+                    pbar.update(len(point_ids) - len(offsets))
+                    if not offsets:
+                        continue
+
+                    images = images_column[[start + offset for offset in offsets]]["image"]
+                    images_bytes = [image_upload_bytes(image, max_pixels) for image in images]
+
+                    # Process and encode a batch of images in one ColPali request
+                    try:
+                        image_embeddings = self.embed_images(images_bytes)
+                    except Exception as e:
+                        if journal is None:
+                            raise
+                        failed_points = [models.PointStruct(id=point_ids[offset], vector={}, payload=row_payload(rows, offset)) for offset in offsets]
+                        journal.mark_failed(failed_points, e)
+                        embed_failed_ids.extend(point.id for point in failed_points)
+                        progress("failed", len(offsets))
+                        pbar.update(len(offsets))
+                        continue
+                    progress("embedded", len(offsets))
+
+                    for offset, image_embedding in zip(offsets, image_embeddings):
+                        vectors = page_vectors(image_embedding, pool_factor, row_page_text(rows, offset))
+                        tokens_before += len(image_embedding)
+                        tokens_after += len(vectors[MULTIVECTOR_NAME])
+                        # Prepare point for Qdrant
+                        point = models.PointStruct(
+                            id=point_ids[offset],  # stable id from PDF content + page
+                            vector=vectors,  # multivector + pooled vector + BM25 text vector
+                            payload=row_payload(rows, offset),  # can also add other metadata/data
+                        )
+
+                        # Queue point, full batches are uploaded in the background
+                        uploader.add(point, estimate_point_bytes(vectors[MULTIVECTOR_NAME]))
+            finally:
+                uploader.close()
+
+        elapsed = time.perf_counter() - start_time
+        failed_ids = embed_failed_ids + uploader.failed_ids
+        stats = {
+            "pages": uploader.uploaded,
+            "skipped": skipped,
+            "failed": len(failed_ids),
+            "failed_ids": failed_ids,
+            "dead_letters": dead_lettered + len(failed_ids),
+            "seconds": elapsed,
+            "pages_per_sec": uploader.uploaded / elapsed if elapsed > 0 else 0.0,
+            "pool_factor": pool_factor,
+            "compression_ratio": tokens_before / tokens_after if tokens_after else 1.0,
+        }
+        if failed_ids:
+            print(f"Failed to ingest {len(failed_ids)} pages: {failed_ids}")
+        if dead_lettered:
+            print(f"{dead_lettered} pages dead-lettered by an earlier run were not retried, use retry_failed")
+        print(f"Indexing complete! {stats['pages']} pages in {elapsed:.1f}s ({stats['pages_per_sec']:.2f} pages/sec), {skipped} already indexed")
+        print(f"Multivector compression: {tokens_before} -> {tokens_after} vectors ({stats['compression_ratio']:.2f}x)")
+        return stats
 
 class SearchClient:
-    def __init__(self, qdrant_uri: str = QDRANT_URI):
-        self.qdrant_client = QdrantClient(qdrant_uri, port=QDRANT_PORT, https=True)
+    def __init__(
+        self,
+        qdrant_uri: str = QDRANT_URI,
+        query_cache: QueryEmbeddingCache = None,
+        backend: str = VECTOR_BACKEND,
+        prefer_grpc: bool = QDRANT_PREFER_GRPC,
+    ):
+        self.qdrant_client = create_vector_client(backend, qdrant_uri, prefer_grpc)
         self.colpali_client = ColPaliClient()
+        self.query_cache = query_cache if query_cache is not None else QueryEmbeddingCache(COLPALI_MODEL_NAME)
+        self.collection_vectors = {}
+
+    def embed_query(self, query_text):
+        # Use ColPaliClient to query text and get the embedding, repeated queries come from the cache
+        return self.query_cache.get_or_compute(
+            query_text, lambda text: self.colpali_client.query_text(text)['embedding']
+        )
+
+    def embed_queries(self, query_texts, batch_size: int = QUERY_EMBED_BATCH_SIZE, max_in_flight: int = SEARCH_MAX_IN_FLIGHT):
+        """Embeddings for many queries: cached ones are reused, the rest go to ColPali in concurrent batches."""
+        embeddings = {query_text: self.query_cache.get(query_text) for query_text in query_texts}
+        missing = [query_text for query_text, embedding in embeddings.items() if embedding is None]
+        batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for batch, response in zip(batches, executor.map(self.colpali_client.query_texts, batches)):
+                for query_text, embedding in zip(batch, response['embeddings']):
+                    self.query_cache.set(query_text, embedding)
+                    embeddings[query_text] = embedding
+        return [embeddings[query_text] for query_text in query_texts]
+
+    def vector_names(self, collection_name: str):
+        # Collections created before named vectors have a single unnamed multivector, and no sparse vectors
+        if collection_name in self.collection_vectors:
+            return self.collection_vectors[collection_name]
+        collection_info = self.qdrant_client.get_collection(collection_name)
+        params = collection_info.config.params
+        vectors = set(params.vectors) if isinstance(params.vectors, dict) else set()
+        vectors |= set(params.sparse_vectors or {})
+        # Not cached for legacy collections, process_collection may recreate them with named vectors
+        if has_named_vectors(collection_info):
+            self.collection_vectors[collection_name] = vectors
+        return vectors
+
+    def query_args(self, query_text, multivector_query, collection_name: str, top_k: int, mode: str, prefetch_limit: int) -> dict:
+        """query_points arguments (also the fields of a models.QueryRequest) for one search in the given mode."""
+        vector_names = self.vector_names(collection_name)
+        using = MULTIVECTOR_NAME if MULTIVECTOR_NAME in vector_names else None
 
-    def search_images_by_text(self, query_text, collection_name: str, top_k=TOP_K):
-        # Use ColPaliClient to query text and get the embedding
-        query_embedding = self.colpali_client.query_text(query_text)
+        if mode == "two_stage":
+            if POOLED_VECTOR_NAME not in vector_names:
+                raise ValueError(f"Collection '{collection_name}' has no '{POOLED_VECTOR_NAME}' vector, re-ingest it to use two_stage search")
+            # HNSW over pooled page vectors picks candidates, exact MaxSim reranks only those
+            return dict(
+                prefetch=models.Prefetch(
+                    query=mean_pool(multivector_query),
+                    using=POOLED_VECTOR_NAME,
+                    limit=max(prefetch_limit, top_k),
+                ),
+                query=multivector_query,
+                using=using,
+                limit=top_k,
+            )
+
+        if mode in ("hybrid", "lexical_rerank"):
+            if TEXT_VECTOR_NAME not in vector_names:
+                raise ValueError(f"Collection '{collection_name}' has no '{TEXT_VECTOR_NAME}' vector, re-ingest it to use {mode} search")
+            text_query = bm25_query_vector(query_text)
+            # Queries without text tokens (only punctuation) fall through to full MaxSim
+            if text_query.indices:
+                text_prefetch = models.Prefetch(query=text_query, using=TEXT_VECTOR_NAME, limit=max(prefetch_limit, top_k))
+                if mode == "lexical_rerank":
+                    # BM25 over page text picks candidates on CPU, exact MaxSim reranks only those
+                    return dict(prefetch=text_prefetch, query=multivector_query, using=using, limit=top_k)
+                # Keyword matches (part numbers, names) and visual matches are fused by rank, their scores aren't comparable
+                return dict(
+                    prefetch=[
+                        text_prefetch,
+                        models.Prefetch(query=multivector_query, using=using, limit=max(prefetch_limit, top_k)),
+                    ],
+                    query=models.FusionQuery(fusion=models.Fusion.RRF),
+                    limit=top_k,
+                )
 
-        # Extract the embedding from the response
-        multivector_query = query_embedding['embedding']
+        return dict(query=multivector_query, using=using, limit=top_k)
 
+    def search_images_by_text(self, query_text, collection_name: str, top_k=TOP_K, mode: str = SEARCH_MODE, prefetch_limit: int = PREFETCH_LIMIT):
+        multivector_query = self.embed_query(query_text)
         # Search in Qdrant
-        search_result = self.qdrant_client.query_points(
-            collection_name=collection_name, query=multivector_query, limit=top_k
+        return self.qdrant_client.query_points(
+            collection_name=collection_name,
+            **self.query_args(query_text, multivector_query, collection_name, top_k, mode, prefetch_limit),
         )
 
-        return search_result
+    def search_images_by_texts(
+        self,
+        query_texts,
+        collection_name: str,
+        top_k=TOP_K,
+        mode: str = SEARCH_MODE,
+        prefetch_limit: int = PREFETCH_LIMIT,
+        batch_size: int = SEARCH_BATCH_SIZE,
+        max_in_flight: int = SEARCH_MAX_IN_FLIGHT,
+    ):
+        """Batched search_images_by_text, one QueryResponse per query in order (used by the evaluation)."""
+        multivector_queries = self.embed_queries(query_texts, max_in_flight=max_in_flight)
+        query_requests = [
+            models.QueryRequest(
+                **self.query_args(query_text, multivector_query, collection_name, top_k, mode, prefetch_limit),
+                with_payload=True,
+            )
+            for query_text, multivector_query in zip(query_texts, multivector_queries)
+        ]
+        batches = [query_requests[start:start + batch_size] for start in range(0, len(query_requests), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            responses = executor.map(lambda batch: self.qdrant_client.query_batch_points(collection_name, batch), batches)
+            return [response for batch_responses in responses for response in batch_responses]
+
 
+def render_pdfium_page(pdf, page_number):
+    # page_number is 0-based, returns (jpeg_bytes, text) from the already opened document
+    page = pdf[page_number]
+    text_page = page.get_textpage()
+    text = text_page.get_text_bounded()
+    pil_image = page.render(scale=PDF_DPI / 72).to_pil()
+    buffered = io.BytesIO()
+    pil_image.save(buffered, format="JPEG", **PDF_JPEG_OPTIONS)
+    text_page.close()
+    page.close()
+    return buffered.getvalue(), text
 
+def get_pdf_images_pdfium(pdf_path):
+    # Single open: the same pdfium document is used for text extraction and rendering
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        pages = [render_pdfium_page(pdf, page_number) for page_number in range(len(pdf))]
+    finally:
+        pdf.close()
+    images = [PIL.Image.open(io.BytesIO(image_bytes)) for image_bytes, _ in pages]
+    page_texts = [text for _, text in pages]
+    return images, page_texts
 
-def get_pdf_images(pdf_path):
+def get_pdf_images(pdf_path, backend: str = PDF_BACKEND):
+    if backend == "pdfium":
+        return get_pdf_images_pdfium(pdf_path)
     reader = PdfReader(pdf_path)
     page_texts = []
     for page_number in range(len(reader.pages)):
@@ -153,32 +775,135 @@ def get_pdf_images(pdf_path):
         text = page.extract_text()
         page_texts.append(text)
     # Convert to PIL images
-    images = convert_from_path(pdf_path, dpi=150, fmt="jpeg", jpegopt={"quality": 100, "progressive": True, "optimize": True})
+    images = convert_from_path(pdf_path, dpi=PDF_DPI, fmt="jpeg", jpegopt=PDF_JPEG_OPTIONS)
     assert len(images) == len(page_texts)
     return images, page_texts
 
-def pdfs_to_hf_dataset(path_to_folder):
-    tracemalloc.start()  # Start tracing memory allocations
+def count_pdf_pages(pdf_path, backend: str = PDF_BACKEND):
+    if backend == "pdfium":
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    return len(PdfReader(pdf_path).pages)
 
-    data = []
-    global_index = 0
+def render_poppler_pages(pdf_path, first_page, last_page, thread_count: int = 1):
+    # JPEG bytes as written by pdftoppm, pages first_page..last_page (1-based, inclusive)
+    with tempfile.TemporaryDirectory() as output_folder:
+        image_paths = convert_from_path(
+            pdf_path,
+            dpi=PDF_DPI,
+            fmt="jpeg",
+            jpegopt=PDF_JPEG_OPTIONS,
+            first_page=first_page,
+            last_page=last_page,
+            thread_count=thread_count,
+            output_folder=output_folder,
+            paths_only=True,
+        )
+        # pdf2image returns the files sorted by page number
+        return [Path(image_path).read_bytes() for image_path in image_paths]
 
-    folder_path = Path(path_to_folder)
-    pdf_files = list(folder_path.glob("*.pdf"))
-    for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
-        images, page_texts = get_pdf_images(str(pdf_file))
+def iter_pdf_pages(pdf_path, backend: str = PDF_BACKEND):
+    # Renders and yields (jpeg_bytes, text) one page at a time, the same bytes as render_pdf_page_range
+    if backend == "pdfium":
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for page_number in range(len(pdf)):
+                yield render_pdfium_page(pdf, page_number)
+        finally:
+            pdf.close()
+        return
+    reader = PdfReader(pdf_path)
+    for page_number in range(1, len(reader.pages) + 1):
+        text = reader.pages[page_number - 1].extract_text()
+        images = render_poppler_pages(pdf_path, page_number, page_number)
+        assert len(images) == 1
+        yield images[0], text
+
+def render_pdf_page_range(pdf_path, first_page, last_page, backend: str = PDF_BACKEND):
+    """
+    Render pages first_page..last_page (1-based, inclusive) of a PDF in a worker process.
+    Returns (jpeg_bytes, text) per page, JPEG bytes are much cheaper to send back than PIL images.
+    """
+    if backend == "pdfium":
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return [render_pdfium_page(pdf, page_number - 1) for page_number in range(first_page, last_page + 1)]
+        finally:
+            pdf.close()
+    reader = PdfReader(pdf_path)
+    page_texts = [reader.pages[page_number - 1].extract_text() for page_number in range(first_page, last_page + 1)]
+    # Parallelism comes from the process pool
+    images = render_poppler_pages(pdf_path, first_page, last_page, thread_count=1)
+    assert len(images) == len(page_texts)
+    return list(zip(images, page_texts))
+
+def iter_pdf_pages_parallel(pdf_files, num_workers=RENDER_WORKERS, pages_per_task=RENDER_PAGES_PER_TASK, backend: str = PDF_BACKEND):
+    """
+    Yields (pdf_file, page_number, jpeg_bytes, text) for every page of every PDF, in
+    the same order as the sequential path. Work is split by PDF and page range across
+    a process pool, at most 2 * num_workers ranges are in flight so memory stays bounded.
+    """
+    tasks = []
+    for pdf_file in pdf_files:
+        num_pages = count_pdf_pages(pdf_file, backend)
+        for first_page in range(1, num_pages + 1, pages_per_task):
+            tasks.append((pdf_file, first_page, min(first_page + pages_per_task - 1, num_pages), backend))
+
+    # Callers (the UI, ingest workers) are multi-threaded and forking them can deadlock the children,
+    # workers only take paths and return bytes, so spawned processes need no inherited state
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        tasks = iter(tasks)
+        for task in tasks:
+            pending.append((task, executor.submit(render_pdf_page_range, *task)))
+            if len(pending) >= 2 * num_workers:
+                break
+        while pending:
+            # Results are consumed in submission order, which keeps the output deterministic
+            (pdf_file, first_page, _, _), future = pending.popleft()
+            for offset, (image_bytes, text) in enumerate(future.result()):
+                yield pdf_file, first_page + offset, image_bytes, text
+            task = next(tasks, None)
+            if task is not None:
+                pending.append((task, executor.submit(render_pdf_page_range, *task)))
+
+def generate_pdf_pages_parallel(pdf_files, num_workers, backend, start_index=0, on_page=None):
+    paths = [pdf_file for pdf_file, _ in pdf_files]
+    hashes = dict(pdf_files)
+    pages = iter_pdf_pages_parallel(paths, num_workers=num_workers, backend=backend)
+    for index, (pdf_file, page_number, image_bytes, text) in enumerate(tqdm(pages, desc="Rendering pages", unit="page"), start=start_index):
+        if on_page is not None:
+            on_page()
+        yield {
+            "image": {"bytes": image_bytes, "path": None},
+            "index": index,
+            "pdf_name": Path(pdf_file).name,
+            "pdf_page": page_number,
+            "page_text": text,
+            "pdf_sha256": hashes[pdf_file],
+        }
+
+def generate_pdf_pages(pdf_files, backend, start_index=0, on_page=None):
+    tracemalloc.start()  # Start tracing memory allocations
 
-        for page_number, (image, text) in enumerate(zip(images, page_texts)):
-            data.append({
-                "image": image,
+    global_index = start_index
+    for pdf_file, pdf_sha256 in tqdm(pdf_files, desc="Processing PDFs"):
+        for page_number, (image_bytes, text) in enumerate(iter_pdf_pages(pdf_file, backend)):
+            if on_page is not None:
+                on_page()
+            # Stored as rendered, like generate_pdf_pages_parallel, datasets would re-encode a PIL image
+            yield {
+                "image": {"bytes": image_bytes, "path": None},
                 "index": global_index,
-                "pdf_name": pdf_file.name,
+                "pdf_name": Path(pdf_file).name,
                 "pdf_page": page_number + 1,
-                "page_text": text
-            })
+                "page_text": text,
+                "pdf_sha256": pdf_sha256,
+            }
             global_index += 1
-            # Print memory usage after processing each image
-            current, peak = tracemalloc.get_traced_memory()
 
         # Print memory usage after processing each PDF
         current, peak = tracemalloc.get_traced_memory()
@@ -188,7 +913,136 @@ def pdfs_to_hf_dataset(path_to_folder):
     print(f"TOTAL: Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
     tracemalloc.stop()  # Stop tracing memory allocations
 
-    print("Done processing")
-    dataset = Dataset.from_list(data)
+def temporary_cache_dir(dataset, cache_dir):
+    # Arrow files of a dataset built in a temporary cache_dir are removed once the dataset is garbage collected
+    weakref.finalize(dataset, shutil.rmtree, cache_dir, ignore_errors=True)
+    return dataset
+
+
+def pdfs_to_hf_dataset(
+    path_to_folder,
+    num_workers: int = 1,
+    backend: str = PDF_BACKEND,
+    skip_pdf_hashes=(),
+    start_index: int = 0,
+    on_page=None,
+    cache_dir: str = None,
+):
+    """
+    Renders the PDFs of a folder into a dataset of pages. num_workers > 1 renders PDFs and
+    page ranges in a process pool (see iter_pdf_pages_parallel), on_page() is called for
+    every rendered page. The Arrow files are written to `cache_dir`, not the global HF
+    datasets cache; callers that save the dataset pass one and delete it after
+    save_to_disk, otherwise a temporary directory is used for the dataset's lifetime.
+    """
+    if cache_dir is None:
+        cache_dir = tempfile.mkdtemp(prefix="pdf_pages_")
+        return temporary_cache_dir(
+            pdfs_to_hf_dataset(path_to_folder, num_workers, backend, skip_pdf_hashes, start_index, on_page, cache_dir), cache_dir
+        )
+
+    folder_path = Path(path_to_folder)
+    # The content hash is part of the generator kwargs, so the datasets cache
+    # fingerprint changes when a PDF in the folder changes
+    pdf_files = [(str(pdf_file), file_sha256(pdf_file)) for pdf_file in sorted(folder_path.glob("*.pdf"))]
+    pdf_files = [(pdf_file, pdf_sha256) for pdf_file, pdf_sha256 in pdf_files if pdf_sha256 not in skip_pdf_hashes]
+    if not pdf_files:
+        return Dataset.from_dict({name: [] for name in PAGE_FEATURES}, features=PAGE_FEATURES)
+
+    # Pages are streamed into Arrow files on disk every DATASET_WRITER_BATCH_SIZE rows,
+    # so peak memory does not grow with the number of pages
+    if num_workers > 1:
+        generator, gen_kwargs = generate_pdf_pages_parallel, {"pdf_files": pdf_files, "num_workers": num_workers, "backend": backend}
+    else:
+        generator, gen_kwargs = generate_pdf_pages, {"pdf_files": pdf_files, "backend": backend}
+    gen_kwargs["start_index"] = start_index
+    if on_page is not None:
+        # only passed when set, it is hashed into the cache fingerprint with the other kwargs
+        gen_kwargs["on_page"] = on_page
+    dataset = Dataset.from_generator(
+        generator,
+        features=PAGE_FEATURES,
+        gen_kwargs=gen_kwargs,
+        writer_batch_size=DATASET_WRITER_BATCH_SIZE,
+        cache_dir=cache_dir,
+    )
     print("Done converting to dataset")
     return dataset
+
+def update_pdfs_hf_dataset(
+    path_to_folder, existing_dataset=None, num_workers: int = 1, backend: str = PDF_BACKEND, on_page=None, cache_dir: str = None
+):
+    """
+    Incremental version of pdfs_to_hf_dataset: only PDFs whose content is not in
+    existing_dataset are rendered, their rows are appended with `index` continuing
+    after the existing ones. Returns (dataset, stale_point_ids), where stale ids are
+    pages of PDFs that were replaced on disk by a different version.
+    Datasets without `pdf_sha256` (created before page ids) are rebuilt from scratch
+    in a new row order, their collection has to be re-ingested (see process_collection).
+    """
+    if cache_dir is None:
+        cache_dir = tempfile.mkdtemp(prefix="pdf_pages_")
+        dataset, stale_point_ids = update_pdfs_hf_dataset(path_to_folder, existing_dataset, num_workers, backend, on_page, cache_dir)
+        return temporary_cache_dir(dataset, cache_dir), stale_point_ids
+
+    if existing_dataset is None or "pdf_sha256" not in existing_dataset.column_names:
+        return pdfs_to_hf_dataset(path_to_folder, num_workers=num_workers, backend=backend, on_page=on_page, cache_dir=cache_dir), []
+
+    current_hashes = {pdf_file.name: file_sha256(pdf_file) for pdf_file in Path(path_to_folder).glob("*.pdf")}
+    existing = existing_dataset.select_columns(["pdf_name", "pdf_page", "pdf_sha256"])[:]
+    stale_point_ids = [
+        page_point_id(pdf_sha256, pdf_page)
+        for pdf_name, pdf_page, pdf_sha256 in zip(existing["pdf_name"], existing["pdf_page"], existing["pdf_sha256"])
+        if pdf_name in current_hashes and current_hashes[pdf_name] != pdf_sha256
+    ]
+
+    new_dataset = pdfs_to_hf_dataset(
+        path_to_folder,
+        num_workers=num_workers,
+        backend=backend,
+        skip_pdf_hashes=set(existing["pdf_sha256"]),
+        start_index=len(existing_dataset),
+        on_page=on_page,
+        cache_dir=cache_dir,
+    )
+    print(f"{len(new_dataset)} new pages, {len(stale_point_ids)} stale pages")
+    return concatenate_datasets([existing_dataset, new_dataset]), stale_point_ids
+
+
+def page_thumbnail(image, size=THUMBNAIL_SIZE) -> bytes:
+    # image is an undecoded {"bytes", "path"} row, JPEGs are decoded at reduced scale (draft mode)
+    source = image["bytes"] if image["bytes"] is not None else Path(image["path"]).read_bytes()
+    pil_image = PIL.Image.open(io.BytesIO(source))
+    pil_image.draft("RGB", size)
+    pil_image = pil_image.convert("RGB")
+    pil_image.thumbnail(size, UPLOAD_RESAMPLE)
+    return pil_to_jpeg_bytes(pil_image, quality=THUMBNAIL_JPEG_QUALITY)
+
+def write_thumbnails(dataset, thumbnail_dir, row_indexes=None, size=THUMBNAIL_SIZE):
+    """
+    Sidecar JPEG thumbnails for dataset rows (all rows by default), one file per page
+    in thumbnail_dir. Files are named by page point id, so thumbnails of unchanged
+    pages survive dataset rebuilds and existing files are not rendered again.
+    Returns the thumbnail paths in the order of row_indexes.
+    """
+    thumbnail_dir = Path(thumbnail_dir)
+    thumbnail_dir.mkdir(parents=True, exist_ok=True)
+    row_indexes = list(range(len(dataset))) if row_indexes is None else list(row_indexes)
+    rows = dataset.remove_columns(["image"])[row_indexes]
+    if "pdf_sha256" in rows:
+        names = [page_point_id(pdf_sha256, pdf_page) for pdf_sha256, pdf_page in zip(rows["pdf_sha256"], rows["pdf_page"])]
+    else:
+        names = [f"row_{index}" for index in rows["index"]]
+    paths = [thumbnail_dir / f"{name}.jpg" for name in names]
+
+    missing = [(row_index, path) for row_index, path in zip(row_indexes, paths) if not path.exists()]
+    images_column = dataset.select_columns(["image"]).cast_column("image", Image(decode=False))
+    for start in range(0, len(missing), DATASET_WRITER_BATCH_SIZE):
+        batch = missing[start:start + DATASET_WRITER_BATCH_SIZE]
+        images = images_column[[row_index for row_index, _ in batch]]["image"]
+        for (_, path), image in zip(batch, images):
+            # write then rename, concurrent readers never see a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(page_thumbnail(image, size))
+            os.replace(tmp_path, path)
+    return [str(path) for path in paths]
@@ -1,5 +1,6 @@
-import json
 import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import PIL.Image
 import pandas as pd
@@ -10,25 +11,105 @@ import PIL
 import base64
 from io import BytesIO
 from pydantic import BaseModel
-from ai_search_demo.qdrant_inexing import IngestClient, SearchClient, pdfs_to_hf_dataset
+from ai_search_demo.cache import AnswerCache
+from ai_search_demo.catalog import CollectionCatalog
+from ai_search_demo.ingest_worker import (
+    HF_DATASET_DIRNAME,
+    PROGRESS_STAGES,
+    THUMBNAILS_DIRNAME,
+    IngestWorkerPool,
+    JobQueue,
+)
+from ai_search_demo.qdrant_inexing import SEARCH_MODE, SEARCH_MODES, SearchClient, write_thumbnails
 
 STORAGE_DIR = "storage"
-COLLECTION_INFO_FILENAME = "collection_info.json"
-HF_DATASET_DIRNAME = "hf_dataset"
 README_FILENAME = "README.md"
 SEARCH_TOP_K = 5
 COLPALI_TOKEN = "super-secret-token"
 VLLM_URL = "https://truskovskiyk--qwen2-vllm-serve.modal.run/v1/"
-search_client = SearchClient()
-ingest_client = IngestClient()
+VLLM_MODEL = "Qwen2-VL-7B-Instruct"
+VLLM_CONCURRENCY = 5  # VLM requests in flight at once for the results of one search
+VLLM_MAX_MODEL_LEN = 8096  # fallback when the vLLM server's /v1/models can't be read (llm-inference/llm_serving.py)
+VLLM_MODELS_TIMEOUT = 10  # seconds, for the /v1/models request
+VLLM_ANSWER_MAX_TOKENS = 512
+VLLM_PROMPT_TOKENS = 512  # reserved for the text part of the prompt and the chat template
+QWEN2_VL_PIXELS_PER_TOKEN = 28 * 28  # one visual token per 28x28 patch after Qwen2-VL's 2x2 merge
+ANSWER_MODES = ["combined", "per_page"]  # one answer over all hits, or one answer per hit
+VLLM_PROMPT_VERSION = "1"  # bump when a prompt template or VLLM_ANSWER_MAX_TOKENS changes, cached answers are keyed on it
+JOBS_REFRESH_SECONDS = 2  # how often the Collections tab polls ingest job progress
 
 # Set Streamlit to use wide mode by default
 st.set_page_config(layout="wide")
 
 
+# One client per Streamlit process, shared by all sessions and reruns, so HTTP
+# connections to ColPali and Qdrant stay open and the query cache stays warm
+@st.cache_resource
+def get_search_client() -> SearchClient:
+    return SearchClient()
 
-def call_vllm(image_data: PIL.Image.Image):
-    model = "Qwen2-VL-7B-Instruct"
+
+@st.cache_resource
+def get_catalog() -> CollectionCatalog:
+    catalog = CollectionCatalog()
+    # collections created before the catalog only have a collection_info.json in their directory
+    catalog.import_collection_dirs(STORAGE_DIR)
+    return catalog
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    return JobQueue()
+
+
+@st.cache_resource
+def start_ingest_workers() -> IngestWorkerPool:
+    # Uploads only enqueue jobs, these threads render and ingest them (see ingest_worker.py)
+    return IngestWorkerPool().start()
+
+
+@st.cache_resource
+def get_vllm_client() -> OpenAI:
+    # Thread safe, shared by the concurrent VLM requests of all sessions
+    return OpenAI(base_url=VLLM_URL, api_key=COLPALI_TOKEN)
+
+
+@st.cache_resource
+def fetch_vllm_max_model_len() -> int:
+    # vLLM adds max_model_len to its /v1/models entries, raising keeps a failed lookup out of the cache
+    models = get_vllm_client().with_options(timeout=VLLM_MODELS_TIMEOUT, max_retries=0).models.list()
+    for model in models:
+        if model.id == VLLM_MODEL and getattr(model, "max_model_len", None):
+            return int(model.max_model_len)
+    raise ValueError(f"{VLLM_MODEL} with max_model_len not found in {VLLM_URL}models")
+
+
+def vllm_max_model_len() -> int:
+    try:
+        return fetch_vllm_max_model_len()
+    except Exception as e:
+        print(f"Using VLLM_MAX_MODEL_LEN={VLLM_MAX_MODEL_LEN}, could not read max_model_len from vLLM: {e}")
+        return VLLM_MAX_MODEL_LEN
+
+
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    # Shared by all sessions of this process, set ANSWER_CACHE_PATH in cache.py to persist it
+    return AnswerCache(VLLM_MODEL, VLLM_PROMPT_VERSION)
+
+
+@st.cache_resource(max_entries=16)
+def load_collection_dataset(dataset_path: str, version: float):
+    # load_from_disk memory-maps the Arrow files, the handle is reused until the dataset is rebuilt (new version)
+    return load_from_disk(dataset_path)
+
+
+def get_collection_dataset(collection_name: str):
+    dataset_path = os.path.join(STORAGE_DIR, collection_name, HF_DATASET_DIRNAME)
+    return load_collection_dataset(dataset_path, os.path.getmtime(os.path.join(dataset_path, "state.json")))
+
+
+def vllm_messages(image_data: PIL.Image.Image):
     prompt = """
     If the user query is a question, try your best to answer it based on the provided images. 
     If the user query can not be interpreted as a question, or if the answer to the query can not be inferred from the images,
@@ -43,23 +124,113 @@ def call_vllm(image_data: PIL.Image.Image):
     image_data.save(buffered, format="JPEG")
     img_b64_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-    client = OpenAI(base_url=VLLM_URL, api_key=COLPALI_TOKEN)
-    chat_completion = client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_b64_str}"},
-                    },
-                ],
-            }
-        ],
-    )
-    return chat_completion.choices[0].message.content
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/jpeg;base64,{img_b64_str}"},
+                },
+            ],
+        }
+    ]
+
+def image_to_data_url(image: PIL.Image.Image) -> str:
+    buffered = BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG")
+    return f"data:image/jpeg;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+
+def fit_image_to_tokens(image: PIL.Image.Image, max_tokens: int) -> PIL.Image.Image:
+    # Downscale so Qwen2-VL encodes the image in at most max_tokens visual tokens
+    max_pixels = max_tokens * QWEN2_VL_PIXELS_PER_TOKEN
+    if image.width * image.height <= max_pixels:
+        return image
+    scale = (max_pixels / (image.width * image.height)) ** 0.5
+    # multiples of 28 so the server side resize (rounding to 28px) can't add tokens
+    size = (max(int(image.width * scale) // 28 * 28, 28), max(int(image.height * scale) // 28 * 28, 28))
+    return image.resize(size, PIL.Image.Resampling.BILINEAR)
+
+def combined_vllm_messages(user_query: str, images, captions, max_model_len: int = VLLM_MAX_MODEL_LEN):
+    """
+    One chat request with all retrieved pages, labeled [1]..[n] so the answer can cite them.
+    Images share what is left of max_model_len after the text prompt and the answer.
+    """
+    image_tokens = (max_model_len - VLLM_PROMPT_TOKENS - VLLM_ANSWER_MAX_TOKENS) // max(len(images), 1)
+    prompt = """
+    Answer the user query using only the provided pages. Cite the pages you used by their number in square brackets, e.g. [2].
+    If the answer can not be inferred from the pages,
+    answer with the exact phrase "I am sorry, I can't find enough relevant information on these pages to answer your question.".
+    """
+    content = [{"type": "text", "text": prompt}]
+    for number, (image, caption) in enumerate(zip(images, captions), start=1):
+        content.append({"type": "text", "text": f"Page [{number}]: {caption}"})
+        content.append({"type": "image_url", "image_url": {"url": image_to_data_url(fit_image_to_tokens(image, image_tokens))}})
+    content.append({"type": "text", "text": f"User query: {user_query}"})
+    return [{"role": "user", "content": content}]
+
+def answer_cache_key(messages, query_text: str = "") -> str:
+    # The images exactly as sent (resized, JPEG, base64) are part of the key
+    image_urls = [part["image_url"]["url"] for message in messages for part in message["content"] if part["type"] == "image_url"]
+    return get_answer_cache().key(image_urls, query_text)
+
+def stream_vllm(messages, max_tokens: int = None):
+    # Yields the answer as text deltas while the VLM generates it
+    stream = get_vllm_client().chat.completions.create(model=VLLM_MODEL, messages=messages, max_tokens=max_tokens, stream=True)
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def stream_vllm_answers(requests, placeholders, concurrency: int = VLLM_CONCURRENCY, max_tokens: int = None, cache_keys=None):
+    """
+    Sends all VLM requests (chat messages) at once, at most `concurrency` in flight, and
+    streams each answer into its placeholder. Worker threads only put text deltas on a
+    queue, Streamlit elements are updated from the script thread.
+    Requests whose cache key has a cached answer are not sent, completed answers are cached.
+    """
+    answer_cache = get_answer_cache()
+    cache_keys = cache_keys or [None] * len(requests)
+    events = queue.Queue()
+
+    def worker(i, messages):
+        try:
+            for delta in stream_vllm(messages, max_tokens):
+                events.put(("delta", i, delta))
+        except Exception as e:
+            events.put(("error", i, e))
+        events.put(("done", i, None))
+
+    answers = [""] * len(requests)
+    pending = []
+    for i, key in enumerate(cache_keys):
+        cached = answer_cache.get(key) if key is not None else None
+        if cached is None:
+            pending.append(i)
+        else:
+            answers[i] = cached
+            placeholders[i].markdown(cached)
+
+    failed = set()
+    remaining = len(pending)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in pending:
+            executor.submit(worker, i, requests[i])
+        while remaining:
+            kind, i, value = events.get()
+            if kind == "delta":
+                answers[i] += value
+                placeholders[i].markdown(answers[i] + "▌")
+            elif kind == "error":
+                failed.add(i)
+                placeholders[i].error(f"VLM request failed: {value}")
+            else:
+                remaining -= 1
+                if i not in failed:
+                    placeholders[i].markdown(answers[i])
+                    if cache_keys[i] is not None:
+                        answer_cache.set(cache_keys[i], answers[i])
+    return answers
 
 def ai_search():
     st.header("AI Search")
@@ -67,55 +238,77 @@ def ai_search():
     # Input form for user query and collection name
     with st.form("search_form"):
         user_query = st.text_input("Enter your search query")
-        if os.path.exists(STORAGE_DIR):
-            collections = os.listdir(STORAGE_DIR)
+        collections = get_catalog().names()
+        if collections:
             collection_name = st.selectbox("Select a collection", collections)
         else:
             st.error("No collections found.")
             collection_name = None
+        search_mode = st.radio("Search mode", SEARCH_MODES, index=SEARCH_MODES.index(SEARCH_MODE), horizontal=True)
+        answer_mode = st.radio("Answer mode", ANSWER_MODES, horizontal=True)
         search_button = st.form_submit_button("Search")
 
     if search_button and user_query and collection_name:
-        collection_info_path = os.path.join(STORAGE_DIR, collection_name, COLLECTION_INFO_FILENAME)
-        
-        if os.path.exists(collection_info_path):
-            with open(collection_info_path, "r") as json_file:
-                collection_info = json.load(json_file)
-                search_results = search_client.search_images_by_text(user_query, collection_name=collection_name, top_k=SEARCH_TOP_K)
-                if search_results:
-                    dataset_path = os.path.join(STORAGE_DIR, collection_name, HF_DATASET_DIRNAME)
-                    dataset = load_from_disk(dataset_path)
-                    
-                    # Collect all search results
-                    search_results_data = []
-                    for result in search_results.points:
-                        payload = result.payload
-                        score = result.score
-                        image_data = dataset[payload['index']]['image']
-                        pdf_name = dataset[payload['index']]['pdf_name']
-                        pdf_page = dataset[payload['index']]['pdf_page']
-                        search_results_data.append((image_data, score, pdf_name, pdf_page))
-                    
-                    # Create columns for displaying results
-                    col1, col2 = st.columns(2)
-                    
-                    # Display images in the first column
-                    with col1:
-                        st.markdown("<h3 style='color:green;'>Relevant Images</h3>", unsafe_allow_html=True)
+        collection_info = get_catalog().get(collection_name)
+
+        if collection_info is not None:
+            try:
+                search_results = get_search_client().search_images_by_text(
+                    user_query, collection_name=collection_name, top_k=SEARCH_TOP_K, mode=search_mode
+                )
+            except ValueError as e:
+                # e.g. hybrid search on a collection ingested before page text was indexed
+                st.error(str(e))
+                return
+            if search_results:
+                dataset = get_collection_dataset(collection_name)
+
+                # Collect all search results with one batched row lookup, full page images are not decoded:
+                # the UI shows sidecar thumbnails (written at ingest, or here for older collections)
+                indexes = [result.payload['index'] for result in search_results.points]
+                rows = dataset.select_columns(["pdf_name", "pdf_page"])[indexes]
+                thumbnail_paths = write_thumbnails(dataset, os.path.join(STORAGE_DIR, collection_name, THUMBNAILS_DIRNAME), indexes)
+                search_results_data = [
+                    (thumbnail_path, result.score, pdf_name, pdf_page)
+                    for thumbnail_path, result, pdf_name, pdf_page in zip(thumbnail_paths, search_results.points, rows["pdf_name"], rows["pdf_page"])
+                ]
+
+                # Create columns for displaying results
+                col1, col2 = st.columns(2)
+                
+                # Display images in the first column
+                with col1:
+                    st.markdown("<h3 style='color:green;'>Relevant Images</h3>", unsafe_allow_html=True)
+                    for image_data, score, pdf_name, pdf_page in search_results_data:
+                        st.image(image_data, caption=f"Score: {score}, PDF Name: {pdf_name}, Page: {pdf_page}")
+                
+                # Display VLLM output in the second column
+                with col2:
+                    st.markdown("<h3 style='color:green;'>Interpretation with LLM</h3>", unsafe_allow_html=True)
+                    if answer_mode == "combined":
+                        # One request with all pages: a single prefill, and the model sees the pages together
+                        captions = [f"PDF Name: {pdf_name}, Page: {pdf_page}" for _, _, pdf_name, pdf_page in search_results_data]
+                        placeholder = st.empty()
+                        placeholder.caption("Processing with VLLM...")
+                        for number, caption in enumerate(captions, start=1):
+                            st.write(f"[{number}] {caption}")
+                        images = dataset.select_columns(["image"])[indexes]["image"]
+                        messages = combined_vllm_messages(user_query, images, captions, max_model_len=vllm_max_model_len())
+                        stream_vllm_answers(
+                            [messages], [placeholder], max_tokens=VLLM_ANSWER_MAX_TOKENS, cache_keys=[answer_cache_key(messages, user_query)]
+                        )
+                    else:
+                        placeholders = []
                         for image_data, score, pdf_name, pdf_page in search_results_data:
-                            st.image(image_data, caption=f"Score: {score}, PDF Name: {pdf_name}, Page: {pdf_page}")
-                    
-                    # Display VLLM output in the second column
-                    with col2:
-                        st.markdown("<h3 style='color:green;'>Interpretation with LLM</h3>", unsafe_allow_html=True)
-                        for image_data, _, _, _ in search_results_data:
-                            with st.spinner("Processing with VLLM..."):
-                                vllm_output = call_vllm(image_data)
-                                
-                                st.write(vllm_output)
-                                st.write(f"Score: {score}, PDF Name: {pdf_name}, Page: {pdf_page}")
-                else:
-                    st.write("No results found.")
+                            placeholders.append(st.empty())
+                            placeholders[-1].caption("Processing with VLLM...")
+                            st.write(f"Score: {score}, PDF Name: {pdf_name}, Page: {pdf_page}")
+                        # the thumbnail is the same 512px image vllm_messages would downscale the page to
+                        requests = [vllm_messages(PIL.Image.open(image_data)) for image_data, _, _, _ in search_results_data]
+                        # the per page prompt does not include the query, so answers are shared between queries
+                        stream_vllm_answers(requests, placeholders, cache_keys=[answer_cache_key(messages) for messages in requests])
+            else:
+                st.write("No results found.")
 
 def create_new_collection():
     st.header("Create PDFs collection")
@@ -123,7 +316,7 @@ def create_new_collection():
     # Create a form for uploading PDFs and entering the collection name
     with st.form("upload_form"):
         uploaded_files = st.file_uploader("Choose multiple PDF files", type="pdf", accept_multiple_files=True)
-        collection_name = st.text_input("Enter the name of the collection")
+        collection_name = st.text_input("Enter the name of the collection (an existing name appends to it)")
         submit_button = st.form_submit_button("Create")
 
     if submit_button and uploaded_files and collection_name:
@@ -139,70 +332,48 @@ def create_new_collection():
                 f.write(uploaded_file.getbuffer())
             file_names.append(uploaded_file.name)
 
-        # Create a JSON file with collection details
-        collection_info = {
-            "name": collection_name,
-            "status": "processing",
-            "number_of_PDFs": len(uploaded_files),
-            "files": file_names
-        }
-        with open(os.path.join(collection_dir, COLLECTION_INFO_FILENAME), "w") as json_file:
-            json.dump(collection_info, json_file)
+        # Register the collection in the catalog, or extend its file list when appending to it
+        get_catalog().add_files(collection_name, file_names, status="queued")
 
-        st.success(f"Uploaded {len(uploaded_files)} PDFs to collection '{collection_name}'")
-
-        # Function to process and ingest PDFs
-        def process_and_ingest():
-            try:
-                # Transform PDFs to HF dataset
-                dataset = pdfs_to_hf_dataset(collection_dir)
-                dataset.save_to_disk(os.path.join(collection_dir, HF_DATASET_DIRNAME))
-
-                # Ingest collection with IngestClient
-                ingest_client = IngestClient()
-                ingest_client.ingest(collection_name, dataset)
-
-                # Update JSON status to 'done'
-                collection_info['status'] = 'done'
-            except Exception as e:
-                # Update JSON status to 'error' in case of any exception
-                collection_info['status'] = 'error'
-                st.error(f"An error occurred: {e}")
-            finally:
-                with open(os.path.join(collection_dir, COLLECTION_INFO_FILENAME), "w") as json_file:
-                    json.dump(collection_info, json_file)
-
-        # Run the processing and ingestion in the current function with a spinner
-        with st.spinner('Processing and ingesting PDFs...'):
-            process_and_ingest()
+        # Rendering and ingestion run in the background workers, progress is on the Collections tab
+        job_id = get_job_queue().enqueue(collection_name, collection_dir)
+        st.success(f"Uploaded {len(uploaded_files)} PDFs to collection '{collection_name}', ingest job {job_id} queued")
 
+@st.fragment(run_every=JOBS_REFRESH_SECONDS)
 def display_all_collections():
     st.header("Previously Uploaded Collections")
 
-    if os.path.exists(STORAGE_DIR):
-        collections = os.listdir(STORAGE_DIR)
-        collection_data = []
-
-        for collection in collections:
-            collection_info_path = os.path.join(STORAGE_DIR, collection, COLLECTION_INFO_FILENAME)
-            if os.path.exists(collection_info_path):
-                with open(collection_info_path, "r") as json_file:
-                    collection_info = json.load(json_file)
-                    collection_data.append(collection_info)
-
-        if collection_data:
-            df = pd.DataFrame(collection_data)
-            st.table(df)
-        else:
-            st.write("No collection data found.")
+    collection_data = get_catalog().list()
+    if collection_data:
+        df = pd.DataFrame(collection_data).drop(columns=["created_at", "updated_at"])
+        st.table(df)
     else:
         st.write("No collections found.")
 
+    st.header("Ingest jobs")
+    jobs = get_job_queue().jobs()
+    if jobs:
+        st.table(pd.DataFrame([
+            {
+                "job": job["id"],
+                "collection": job["collection_name"],
+                "status": job["status"],
+                "stage": job["stage"],
+                **{stage: job["progress"].get(stage, 0) for stage in PROGRESS_STAGES},
+                "error": job["error"],
+            }
+            for job in jobs
+        ]))
+    else:
+        st.write("No ingest jobs yet.")
+
 def about():
     with open(README_FILENAME, "r") as readme_file:
         readme_content = readme_file.read()
     st.markdown(readme_content)
 
+start_ingest_workers()
+
 tab1, tab2, tab3, tab4 = st.tabs(["AI Search", "Upload", "Collections", "About"])
 
 with tab1:
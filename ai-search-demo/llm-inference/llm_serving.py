@@ -20,6 +20,8 @@ app = modal.App("qwen2-vllm")
 
 N_GPU = 1  # tip: for best results, first upgrade to more powerful GPUs, and only then increase GPU count
 TOKEN = "super-secret-token"  # auth token. for production use, replace with a modal.Secret
+MAX_MODEL_LEN = 8096  # the UI reads it from /v1/models to size multi-image prompts (VLLM_MAX_MODEL_LEN in ui.py is the fallback)
+MAX_IMAGES_PER_PROMPT = 5  # top-k pages answered in one request
 
 MINUTES = 60  # seconds
 HOURS = 60 * MINUTES
@@ -91,7 +93,8 @@ def serve():
         model=MODELS_DIR + "/" + MODEL_NAME,
         tensor_parallel_size=N_GPU,
         gpu_memory_utilization=0.90,
-        max_model_len=8096,
+        max_model_len=MAX_MODEL_LEN,
+        limit_mm_per_prompt={"image": MAX_IMAGES_PER_PROMPT},
         enforce_eager=False,  # capture the graph for faster inference, but slower cold starts (30s > 20s)
     )
 
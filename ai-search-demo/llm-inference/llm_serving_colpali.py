@@ -1,3 +1,7 @@
+import asyncio
+import io
+import re
+
 import modal
 
 vllm_image = modal.Image.debian_slim(python_version="3.12").pip_install(
@@ -19,11 +23,108 @@ app = modal.App("colpali-embedding")
 
 N_GPU = 1
 TOKEN = "super-secret-token"
+MAX_IMAGE_BATCH_SIZE = 16  # max images per forward pass
+MAX_QUERY_BATCH_SIZE = 64  # max queries per forward pass
+BATCH_WINDOW_MS = 10  # how long to wait for more requests before running a batch
+
+NPY_MEDIA_TYPE = "application/x-npy"  # one embedding as a .npy file (dtype + shape header, raw values)
+NPZ_MEDIA_TYPE = "application/x-npz"  # several embeddings as an uncompressed .npz, arr_0, arr_1, ...
+WIRE_DTYPES = ("float16", "float32")
 
 MINUTES = 60  # seconds
 HOURS = 60 * MINUTES
 
 
+def wire_dtype(accept: str) -> str:
+    # e.g. "application/x-npy; dtype=float16", float32 when no dtype is given
+    match = re.search(r"dtype=(\w+)", accept)
+    dtype = match.group(1) if match else "float32"
+    return dtype if dtype in WIRE_DTYPES else "float32"
+
+
+def embedding_response(request, embedding):
+    """Binary .npy body when the client accepts it, JSON lists otherwise."""
+    import fastapi
+    import numpy as np
+
+    accept = request.headers.get("accept", "")
+    if NPY_MEDIA_TYPE not in accept:
+        return {"embedding": embedding.tolist()}
+    buffer = io.BytesIO()
+    np.save(buffer, embedding.astype(wire_dtype(accept)), allow_pickle=False)
+    return fastapi.Response(content=buffer.getvalue(), media_type=NPY_MEDIA_TYPE)
+
+
+def embeddings_response(request, embeddings):
+    # Pages have different numbers of tokens, so each embedding is its own array in the .npz
+    import fastapi
+    import numpy as np
+
+    accept = request.headers.get("accept", "")
+    if NPZ_MEDIA_TYPE not in accept:
+        return {"embeddings": [embedding.tolist() for embedding in embeddings]}
+    buffer = io.BytesIO()
+    np.savez(buffer, *[embedding.astype(wire_dtype(accept)) for embedding in embeddings])
+    return fastapi.Response(content=buffer.getvalue(), media_type=NPZ_MEDIA_TYPE)
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into one model call. Items arriving within
+    `window_ms` of the first one, up to `max_batch_size`, are passed together to
+    `process_batch` in a worker thread, and each caller gets back its own result.
+    """
+
+    def __init__(self, process_batch, max_batch_size: int, window_ms: float):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.window_ms = window_ms
+        self.queue = None
+        self.worker = None
+
+    async def submit(self, item):
+        if self.worker is None:
+            # created lazily, the queue and the task must live on the server event loop
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # callers that went away (client disconnect) don't need a slot in the batch
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                # model work runs off the event loop so new requests keep queueing up
+                results = await asyncio.to_thread(self.process_batch, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
 @app.function(
     image=vllm_image,
     gpu=modal.gpu.A100(count=N_GPU),
@@ -35,6 +136,8 @@ HOURS = 60 * MINUTES
 )
 @modal.asgi_app()
 def serve():
+    import threading
+
     import fastapi
     import torch
     from colpali_engine.models import ColQwen2, ColQwen2Processor
@@ -86,22 +189,54 @@ def serve():
 
     colpali_processor = ColQwen2Processor.from_pretrained(model_name)
 
+    # one forward pass at a time on the GPU, query and image batches take turns
+    model_lock = threading.Lock()
+
+    def embed(batch):
+        with model_lock, torch.no_grad():
+            batch = batch.to(colpali_model.device)
+            embeddings = colpali_model(**batch)
+            # drop padding tokens so every item gets only its own vectors
+            return [
+                embedding[mask.bool()].cpu().float().numpy()
+                for embedding, mask in zip(embeddings, batch["attention_mask"])
+            ]
+
+    def embed_queries(query_texts):
+        return embed(colpali_processor.process_queries(query_texts))
+
+    def embed_images(pil_images):
+        return embed(colpali_processor.process_images(pil_images))
+
+    query_batcher = MicroBatcher(embed_queries, MAX_QUERY_BATCH_SIZE, BATCH_WINDOW_MS)
+    image_batcher = MicroBatcher(embed_images, MAX_IMAGE_BATCH_SIZE, BATCH_WINDOW_MS)
+
     # Define a simple endpoint to process text queries
     @router.post("/query")
-    async def query_model(query_text: str):
-        with torch.no_grad():
-            batch_query = colpali_processor.process_queries([query_text]).to(colpali_model.device)
-            query_embedding = colpali_model(**batch_query)
-        return {"embedding": query_embedding[0].cpu().float().numpy().tolist()}
+    async def query_model(query_text: str, request: fastapi.Request):
+        query_embedding = await query_batcher.submit(query_text)
+        return embedding_response(request, query_embedding)
+
+    @router.post("/queries")
+    async def query_models(request: fastapi.Request, query_texts: list[str] = fastapi.Body(...)):
+        # the batcher splits these into forward passes of at most MAX_QUERY_BATCH_SIZE
+        embeddings = await asyncio.gather(*[query_batcher.submit(query_text) for query_text in query_texts])
+        return embeddings_response(request, embeddings)
 
     @router.post("/process_image")
-    async def process_image(image: fastapi.UploadFile):
+    async def process_image(image: fastapi.UploadFile, request: fastapi.Request):
         from PIL import Image
         pil_image = Image.open(image.file)
-        with torch.no_grad():
-            batch_image = colpali_processor.process_images([pil_image]).to(colpali_model.device)
-            image_embedding = colpali_model(**batch_image)
-        return {"embedding": image_embedding[0].cpu().float().numpy().tolist()}
+        image_embedding = await image_batcher.submit(pil_image)
+        return embedding_response(request, image_embedding)
+
+    @router.post("/process_images")
+    async def process_images(images: list[fastapi.UploadFile], request: fastapi.Request):
+        from PIL import Image
+        pil_images = [Image.open(image.file) for image in images]
+        # the batcher splits these into forward passes of at most MAX_IMAGE_BATCH_SIZE
+        embeddings = await asyncio.gather(*[image_batcher.submit(pil_image) for pil_image in pil_images])
+        return embeddings_response(request, embeddings)
 
     
     # add authed router to our fastAPI app